@@ -0,0 +1,62 @@
+import asyncio
+
+# Max sends scheduled at once by a single broadcast, so a large audience doesn't monopolize the loop
+FAN_OUT_CHUNK_SIZE = 50
+
+async def fan_out(sends):
+    """Await send coroutines concurrently and return their results (exceptions included) in order.
+
+    Sends are gathered FAN_OUT_CHUNK_SIZE at a time, yielding to the event loop between chunks.
+    """
+    if len(sends) <= FAN_OUT_CHUNK_SIZE:
+        return await asyncio.gather(*sends, return_exceptions=True)
+    results = []
+    for start in range(0, len(sends), FAN_OUT_CHUNK_SIZE):
+        if start:
+            await asyncio.sleep(0)
+        results.extend(await asyncio.gather(*sends[start:start + FAN_OUT_CHUNK_SIZE], return_exceptions=True))
+    return results
+
+class ConnectionRegistry:
+    """Connections (WebSockets or client wrappers) subscribed to each stream.
+
+    A stream's entry is dropped as soon as its last connection is removed, so
+    `get` never returns an empty set that lingers after clients leave.
+    """
+
+    def __init__(self):
+        self._connections = {}  # stream_id -> set of connections
+
+    def add(self, stream_id, connection):
+        self._connections.setdefault(stream_id, set()).add(connection)
+
+    def discard(self, stream_id, connection):
+        connections = self._connections.get(stream_id)
+        if connections is None:
+            return
+        connections.discard(connection)
+        if not connections:
+            del self._connections[stream_id]
+
+    def get(self, stream_id):
+        """Return the stream's connections (an empty tuple if there are none)."""
+        return self._connections.get(stream_id, ())
+
+    def __len__(self):
+        return sum(len(connections) for connections in self._connections.values())
+
+    async def broadcast(self, stream_id, send):
+        """Call `send(connection)` for every connection of a stream and await the sends concurrently.
+
+        Connections whose send raises are removed. Returns the number removed.
+        """
+        targets = list(self.get(stream_id))
+        if not targets:
+            return 0
+        results = await fan_out([send(connection) for connection in targets])
+        failed = 0
+        for connection, result in zip(targets, results):
+            if isinstance(result, Exception):
+                self.discard(stream_id, connection)
+                failed += 1
+        return failed
@@ -0,0 +1,152 @@
+import time
+from collections import OrderedDict, deque
+
+import cv2
+import numpy as np
+
+class ResponseCache:
+    """Bounded LRU cache with a per-entry TTL for vision model responses.
+
+    Keys are expected to include the content hash of the frame along with
+    anything that changes the answer (model name, prompt version).
+    """
+
+    def __init__(self, maxsize=1024, ttl=60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._entries),
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+def grayscale_thumbnail(jpeg_bytes, size=64):
+    """Decode a JPEG into a `size`x`size` uint8 grayscale thumbnail, or None if it cannot be decoded."""
+    # Decode at 1/4 scale straight to grayscale; nothing downstream needs full resolution or color
+    img = cv2.imdecode(np.frombuffer(jpeg_bytes, dtype=np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_4)
+    if img is None:
+        return None
+    return cv2.resize(img, (size, size), interpolation=cv2.INTER_AREA)
+
+def perceptual_hash(thumbnail, hash_size=16):
+    """Compute a DCT perceptual hash (pHash) of a grayscale thumbnail as a `hash_size**2`-bit int.
+
+    The thumbnail should be `hash_size * 4` pixels square (see `grayscale_thumbnail`).
+    """
+    low_freq = cv2.dct(np.float32(thumbnail))[:hash_size, :hash_size]
+    bits = (low_freq > np.median(low_freq)).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+class PerceptualHashCache:
+    """Ring buffer of recent `(phash, value)` pairs matched by Hamming distance.
+
+    Entries older than `ttl` seconds are ignored, so a slowly changing scene
+    (e.g. dusk) is eventually re-checked even if every frame is a near match.
+    """
+
+    def __init__(self, capacity=32, max_distance=8, ttl=300.0):
+        self.max_distance = max_distance
+        self.ttl = ttl
+        self._entries = deque(maxlen=capacity)  # (expires_at, phash, value)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, phash):
+        best_value, best_distance = None, self.max_distance
+        now = time.monotonic()
+        for expires_at, cached_hash, value in self._entries:
+            if expires_at < now:
+                continue
+            distance = (phash ^ cached_hash).bit_count()
+            if distance < best_distance:
+                best_value, best_distance = value, distance
+        if best_value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return best_value
+
+    def put(self, phash, value):
+        self._entries.append((time.monotonic() + self.ttl, phash, value))
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._entries),
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+class MotionGate:
+    """Tells when a fixed camera's scene is unchanged since its last classification.
+
+    Each thumbnail is compared with the thumbnail of the last frame the model actually
+    classified (mean absolute difference per pixel), so slow drift adds up until it
+    crosses `threshold` instead of hiding between consecutive frames. The scene counts
+    as static once `quiet_frames` consecutive thumbnails are within `threshold`, but a
+    real classification is still forced after `max_skips` reused results or `max_age`
+    seconds since the last one.
+
+    Frames carry increasing sequence numbers; a classification finishing after a newer
+    one never moves the reference back to an older frame.
+    """
+
+    def __init__(self, threshold=2.0, quiet_frames=3, max_skips=10, max_age=30.0):
+        self.threshold = threshold
+        self.quiet_frames = quiet_frames
+        self.max_skips = max_skips
+        self.max_age = max_age
+        self._reference = None  # (seq, thumbnail, monotonic time) of the last classified frame
+        self._quiet_count = 0
+        self._skips_since_reference = 0
+        self.skipped = 0
+
+    def is_static(self, thumbnail):
+        """True if this frame may reuse the last classification (counted in `skipped`). Call in frame order."""
+        reference = self._reference
+        if reference is None or reference[1].shape != thumbnail.shape:
+            self._quiet_count = 0
+            return False
+        # One fused pass in OpenCV: no int16 copy or difference array per frame
+        delta = cv2.norm(thumbnail, reference[1], cv2.NORM_L1) / thumbnail.size
+        if delta >= self.threshold:
+            self._quiet_count = 0
+            return False
+        self._quiet_count += 1
+        if (self._quiet_count < self.quiet_frames or self._skips_since_reference >= self.max_skips
+                or time.monotonic() - reference[2] >= self.max_age):
+            return False
+        self._skips_since_reference += 1
+        self.skipped += 1
+        return True
+
+    def classified(self, seq, thumbnail):
+        """Make frame `seq`'s thumbnail the reference after the model classified it."""
+        if self._reference is None or seq > self._reference[0]:
+            self._reference = (seq, thumbnail, time.monotonic())
+            self._skips_since_reference = 0
@@ -1,17 +1,23 @@
 import asyncio
-import json
+import os
+import orjson
+import msgpack
+import pybase64
 import logging
 import time
-import datetime  # Add datetime for ISO timestamp generation
+from collections import deque
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.websockets import WebSocketState
+from fastapi.responses import ORJSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-from collections import defaultdict
 
 # Import configurations and the processor
 from streams_config import STREAMS
-from stream_processor import VideoStreamProcessor
+from stream_processor import (
+    VideoStreamProcessor, close_http_clients, warm_up_vision_client, classification_cache, description_cache
+)
+from connection_registry import ConnectionRegistry
 
 # --- Logging Setup ---
 # Basic logging setup (can be enhanced)
@@ -21,14 +27,31 @@ logger = logging.getLogger(__name__)
 # --- Global State ---
 # Dictionary to hold stream processor instances, keyed by stream_id
 stream_processors = {}
-# Dictionary to hold active WebSocket connections for each stream_id
-# Structure: {stream_id: {websocket1, websocket2, ...}}
-active_connections = defaultdict(set)
-# Similar structure for analysis connections
-analysis_connections = defaultdict(set)
-# Background broadcast tasks references
-stream_broadcast_task = None
-analysis_broadcast_task = None
+# Active frame clients for each stream_id: {stream_id: {FrameClient1, FrameClient2, ...}}
+active_connections = ConnectionRegistry()
+# Analysis WebSockets for each stream_id
+analysis_connections = ConnectionRegistry()
+# Analysis connections that asked for MessagePack (?format=msgpack) instead of JSON
+msgpack_analysis_connections = set()
+# JSON /ws/analyze connections that asked for alert frames as separate binary messages (?frames=binary)
+binary_frame_analysis_connections = set()
+# Legacy /ws/combined clients, fed by the broadcast loop: {stream_id: {FrameClient, ...}}
+combined_connections = ConnectionRegistry()
+# Background broadcast task reference
+broadcast_task = None
+# Most recently encoded wire payloads, shared by the broadcast and newly connecting clients
+# Structure: {(stream_id, kind): (frame_seq, payload)}
+latest_wire_payloads = {}
+# Seconds between sweeps of the processors' analysis message queues
+ANALYSIS_BROADCAST_INTERVAL = 0.1
+
+# Frames buffered per video client; older frames are dropped first when a client falls behind
+FRAME_CLIENT_QUEUE_SIZE = 2
+
+# The legacy combined endpoint can be switched off ahead of its removal
+LEGACY_COMBINED_WS_ENABLED = os.environ.get("ENABLE_LEGACY_COMBINED_WS", "1") == "1"
+# Minimum seconds between combined messages for a stream (~10 FPS, like the old per-client loop)
+LEGACY_COMBINED_INTERVAL = 0.1
 
 # --- Helper Functions ---
 def get_stream_processor(stream_id: str) -> VideoStreamProcessor:
@@ -37,116 +60,284 @@ def get_stream_processor(stream_id: str) -> VideoStreamProcessor:
         raise HTTPException(status_code=404, detail=f"Stream '{stream_id}' not found.")
     return processor
 
-# --- Background Tasks ---
-async def stream_broadcast_loop():
-    """Continuously broadcast latest frames to connected clients."""
-    # For video streaming, we want to maintain ~30 FPS
-    interval = 1.0 / 30.0  # 33.3ms interval for ~30 FPS
+async def wait_for_disconnect(ws: WebSocket):
+    """Return once the client disconnects, discarding anything it sends (text or binary) meanwhile."""
+    while True:
+        message = await ws.receive()
+        if message["type"] == "websocket.disconnect":
+            return
 
-    logger.info(f"Starting stream broadcast loop with interval: {interval:.3f}s")
+async def close_if_open(ws: WebSocket):
+    """Close the server side of a WebSocket unless either side has already closed it."""
+    if ws.client_state == WebSocketState.DISCONNECTED or ws.application_state == WebSocketState.DISCONNECTED:
+        return
+    try:
+        await ws.close()
+    except Exception:
+        pass
 
-    while True:
-        start_time = time.monotonic()
-        try:
-            # Iterate through streams that have active connections
-            for stream_id, connections in list(active_connections.items()):
-                if not connections: # Skip if no connections for this stream
-                    continue
-                    
-                processor = stream_processors.get(stream_id)
-                if not processor:
-                    logger.warning(f"Processor for stream '{stream_id}' not found during broadcast.")
-                    continue
+def encode_json_message(message):
+    """Encode a message as JSON text; raw bytes (e.g. alert frames) become base64 strings."""
+    return orjson.dumps(message, default=_json_default).decode()
+
+def _json_default(obj):
+    if isinstance(obj, bytes):
+        return pybase64.b64encode_as_string(obj)
+    raise TypeError
+
+def encode_msgpack_message(message):
+    """Encode a message as MessagePack; raw bytes stay binary."""
+    return msgpack.packb(message, use_bin_type=True)
+
+def encode_frame_message(stream_id, frame_state):
+    """Encode a frame with its metadata as MessagePack; the JPEG goes in as a raw `bin` field."""
+    return encode_msgpack_message({
+        "type": "frame",
+        "stream_id": stream_id,
+        "seq": frame_state.seq,
+        "ts": frame_state.captured_at,
+        "frame": frame_state.jpeg
+    })
+
+def cached_wire_payload(stream_id, kind, version, encode):
+    """Return the `kind` payload for a stream at `version` (e.g. its frame seq), calling `encode()` only if it isn't cached."""
+    cached = latest_wire_payloads.get((stream_id, kind))
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    payload = encode()
+    latest_wire_payloads[(stream_id, kind)] = (version, payload)
+    return payload
+
+def frame_wire_payload(stream_id, frame_state):
+    """MessagePack frame+metadata message for a frame, encoded once per frame."""
+    return cached_wire_payload(
+        stream_id, "frame_msgpack", frame_state.seq, lambda: encode_frame_message(stream_id, frame_state)
+    )
+
+def combined_wire_payload(stream_id, processor):
+    """Legacy combined JSON message for the stream's latest frame, encoded once per frame and detection update."""
+    # The message embeds the detection result too, which can change without a new frame
+    return cached_wire_payload(
+        stream_id, "combined_json", (processor.frame_seq, processor.detection_version), processor.get_latest_data_json
+    )
+
+def coalesce_analysis_messages(messages):
+    """Keep every accident alert but only the newest classification update, preserving order."""
+    last_update = None
+    for index, message in enumerate(messages):
+        if message["type"] == "classification_update":
+            last_update = index
+    return [
+        message for index, message in enumerate(messages)
+        if message["type"] != "classification_update" or index == last_update
+    ]
 
-                # Get the latest frame only
-                frame_b64 = processor.get_latest_frame_base64()
-                
-                # Skip if no frame is available
-                if frame_b64 is None:
+def split_alert_frames(message):
+    """Return a copy of `message` without the alert frames (also inside a batch) and the frames, in order."""
+    frames = []
+
+    def strip(item):
+        if item.get("type") == "accident_alert" and item.get("frame") is not None:
+            frames.append(item["frame"])
+            return {**item, "frame": None, "frame_follows": True}
+        return item
+
+    if message.get("type") == "batch":
+        return {**message, "items": [strip(item) for item in message["items"]]}, frames
+    return strip(message), frames
+
+class AnalysisMessageSender:
+    """Sends one analysis message to each connection in its wire format, encoding it at most once per format."""
+
+    def __init__(self, message):
+        self.message = message
+        self._json = None
+        self._msgpack = None
+        self._split = None  # (JSON without alert frames, [raw JPEG frames])
+
+    def __call__(self, connection):
+        if connection in msgpack_analysis_connections:
+            if self._msgpack is None:
+                self._msgpack = encode_msgpack_message(self.message)
+            return connection.send_bytes(self._msgpack)
+        if connection in binary_frame_analysis_connections:
+            if self._split is None:
+                message, frames = split_alert_frames(self.message)
+                self._split = encode_json_message(message), frames
+            return self._send_with_binary_frames(connection, *self._split)
+        if self._json is None:
+            self._json = encode_json_message(self.message)
+        return connection.send_text(self._json)
+
+    @staticmethod
+    async def _send_with_binary_frames(connection, text, frames):
+        # The JSON goes first; each alert's JPEG follows as its own binary message, without base64
+        await connection.send_text(text)
+        for frame in frames:
+            await connection.send_bytes(frame)
+
+class FrameClient:
+    """A /ws/stream (or legacy /ws/combined) connection with its own bounded frame queue,
+    drained by a dedicated sender task.
+
+    The broadcast loop only enqueues, so a slow client falls behind on its own
+    (losing its oldest frames) instead of stalling every other client.
+    """
+
+    def __init__(self, ws, maxsize=FRAME_CLIENT_QUEUE_SIZE, text=False, with_metadata=False):
+        self.ws = ws
+        # A bounded deque drops the oldest frame by itself; the event wakes the sender
+        self.queue = deque(maxlen=maxsize)
+        self._ready = asyncio.Event()
+        self.dropped = 0
+        # Frame clients that asked for ?format=msgpack get each JPEG wrapped with its stream_id/seq/ts
+        self.with_metadata = with_metadata
+        self._send = ws.send_text if text else ws.send_bytes
+
+    def offer(self, frame_bytes):
+        """Queue a frame without blocking, dropping the oldest queued frame if the queue is full."""
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+        self.queue.append(frame_bytes)
+        self._ready.set()
+
+    async def run_sender(self):
+        """Send queued frames until the connection fails or the task is cancelled."""
+        try:
+            while True:
+                if not self.queue:
+                    self._ready.clear()
+                    await self._ready.wait()
                     continue
-                    
-                # Create the frame-only message
-                message = json.dumps({
-                    "type": "frame",
-                    "stream_id": stream_id,
-                    "frame": frame_b64,
-                    "timestamp": datetime.datetime.utcnow().isoformat()
-                })
-                
-                # Send to all connected clients for this stream
-                # Use a copy of the set for safe iteration during removal
-                dead_connections = set()
-                for connection in list(connections):
-                    try:
-                        await connection.send_text(message)
-                    except Exception as e:
-                        dead_connections.add(connection)
-                
-                # Remove dead connections from the original set
-                for dead in dead_connections:
-                    connections.discard(dead)
-                
-                # Clean up stream_id entry if no connections left
-                if not connections:
-                    del active_connections[stream_id]
-                    logger.info(f"No active connections left for stream '{stream_id}', removed from broadcast list.")
-
-            # Sleep to maintain target frame rate
-            elapsed = time.monotonic() - start_time
-            sleep_time = max(0, interval - elapsed)
-            await asyncio.sleep(sleep_time)
-            
+                await self._send(self.queue.popleft())
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            logger.error(f"Error in stream broadcast loop: {e}", exc_info=True)
-            await asyncio.sleep(1) # Avoid tight loops on major error
+            logger.info(f"Frame sender for {id(self.ws)} stopped: {e}")
+
+# --- Background Tasks ---
+def broadcast_frame(stream_id, processor, combined_state):
+    """Queue a stream's newest frame for its video clients and, when due, its legacy combined clients."""
+    # Always take the newest frame, even with no clients, so nothing stale is left for the next one to connect
+    frame_state = processor.next_frame_for_broadcast()
+    connections = active_connections.get(stream_id)
+    if connections:
+        # Hand the frame to every client's sender task; its raw JPEG bytes are sent as-is to most clients.
+        # Nothing here waits on the network, and disconnected clients are removed by their own handlers
+        if frame_state is not None:
+            for client in connections:
+                if client.with_metadata:
+                    # Encoded on first use, and only if some client wants metadata
+                    client.offer(frame_wire_payload(stream_id, frame_state))
+                else:
+                    client.offer(frame_state.jpeg)
+    broadcast_combined(stream_id, processor, combined_state)
+
+def broadcast_combined(stream_id, processor, combined_state):
+    """Queue the legacy combined message for a stream's combined clients if its frame or detection changed."""
+    combined = combined_connections.get(stream_id)
+    if not combined:
+        return
+    now = time.monotonic()
+    version = (processor.frame_seq, processor.detection_version)
+    last_sent, last_version = combined_state.get(stream_id, (0, None))
+    if version != last_version and now - last_sent >= LEGACY_COMBINED_INTERVAL:
+        # Legacy clients share one encoded frame+detection message per tick
+        combined_state[stream_id] = (now, version)
+        payload = combined_wire_payload(stream_id, processor)
+        for client in combined:
+            client.offer(payload)
+
+def drain_analysis_messages():
+    """Collect `(stream_id, message)` for every stream with analysis clients and queued messages."""
+    outgoing = []
+    for stream_id, processor in stream_processors.items():
+        if not analysis_connections.get(stream_id):
+            # Skip if no analysis clients for this stream
+            continue
+        
+        # Drain everything queued since the last sweep in one go
+        if not processor.broadcast_queue:
+            continue
+        messages = list(processor.broadcast_queue)
+        processor.broadcast_queue.clear()
+        
+        # Several messages go out together as one batch message
+        messages = coalesce_analysis_messages(messages)
+        message = messages[0] if len(messages) == 1 else {"type": "batch", "stream_id": stream_id, "items": messages}
+        outgoing.append((stream_id, message))
+    return outgoing
 
-async def analysis_broadcast_loop():
-    """Continuously check for and broadcast accident alerts to analysis clients."""
-    logger.info("Starting analysis broadcast loop...")
+async def send_analysis_messages(outgoing):
+    """Send drained analysis messages to each stream's analysis clients concurrently."""
+    # Dead connections are dropped by the registry
+    await asyncio.gather(*(
+        analysis_connections.broadcast(stream_id, AnalysisMessageSender(message))
+        for stream_id, message in outgoing
+    ))
+
+async def broadcast_loop():
+    """Single scheduler for all WebSocket output.
+
+    New frames are handed to video clients as soon as they are published; every
+    ANALYSIS_BROADCAST_INTERVAL the analysis queues are swept and sent to analysis clients.
+    """
+    logger.info("Starting broadcast loop...")
+    loop = asyncio.get_running_loop()
+    # One long-lived waiter task per processor (task -> stream_id), replaced only after its event fires
+    frame_waiters = {
+        asyncio.create_task(processor.new_frame_event.wait()): stream_id
+        for stream_id, processor in stream_processors.items()
+    }
+    # When each stream last sent a legacy combined message, and the (frame_seq, detection_version) it carried
+    combined_state = {}
+    next_analysis_sweep = loop.time()
+    # Analysis sends run in the background so a slow analysis client never delays frames;
+    # a new sweep waits for the previous one so messages stay in order
+    analysis_send_task = None
 
     while True:
         try:
-            # Check each stream processor for accident alerts in their broadcast queue
-            for stream_id, processor in stream_processors.items():
-                if stream_id not in analysis_connections or not analysis_connections[stream_id]:
-                    # Skip if no analysis clients for this stream
-                    continue
-                
-                # Non-blocking check for messages in the broadcast queue
-                if not processor.broadcast_queue.empty():
-                    # Get the message from the queue
-                    message = processor.broadcast_queue.get_nowait()
-                    message_json = json.dumps(message)
-                    
-                    # Send to all connected analysis clients for this stream
-                    dead_connections = set()
-                    for connection in list(analysis_connections[stream_id]):
-                        try:
-                            await connection.send_text(message_json)
-                        except Exception as e:
-                            dead_connections.add(connection)
-                    
-                    # Remove dead connections
-                    for dead in dead_connections:
-                        analysis_connections[stream_id].discard(dead)
-                    
-                    # Clean up if no connections left
-                    if not analysis_connections[stream_id]:
-                        del analysis_connections[stream_id]
-            
-            # Sleep briefly to avoid consuming too many resources
-            await asyncio.sleep(0.1)
+            # Sleep until some processor publishes a frame or the next analysis sweep is due
+            timeout = max(0, next_analysis_sweep - loop.time())
+            done, _ = await asyncio.wait(frame_waiters.keys(), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            for waiter in done:
+                stream_id = frame_waiters.pop(waiter)
+                processor = stream_processors[stream_id]
+                processor.new_frame_event.clear()
+                frame_waiters[asyncio.create_task(processor.new_frame_event.wait())] = stream_id
+                broadcast_frame(stream_id, processor, combined_state)
+
+            if loop.time() >= next_analysis_sweep:
+                next_analysis_sweep = loop.time() + ANALYSIS_BROADCAST_INTERVAL
+                # Detection updates reach legacy combined clients even while no new frame arrives
+                for stream_id, processor in stream_processors.items():
+                    broadcast_combined(stream_id, processor, combined_state)
+                if analysis_send_task is None or analysis_send_task.done():
+                    outgoing = drain_analysis_messages()
+                    if outgoing:
+                        analysis_send_task = asyncio.create_task(send_analysis_messages(outgoing))
             
+        except asyncio.CancelledError:
+            for waiter in frame_waiters:
+                waiter.cancel()
+            if analysis_send_task:
+                analysis_send_task.cancel()
+            raise
         except Exception as e:
-            logger.error(f"Error in analysis broadcast loop: {e}", exc_info=True)
-            await asyncio.sleep(1)
+            logger.error(f"Error in broadcast loop: {e}", exc_info=True)
+            await asyncio.sleep(1) # Avoid tight loops on major error
 
 # --- Application Lifespan (Startup/Shutdown) ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
     logger.info("Application startup...")
-    global stream_processors, stream_broadcast_task, analysis_broadcast_task
+    global stream_processors, broadcast_task
+    
+    # Open the Together connection in the background so the first classification doesn't pay for TLS setup
+    warm_up_task = asyncio.create_task(warm_up_vision_client())
     
     # Initialize and start processors for each configured stream
     for config in STREAMS:
@@ -154,47 +345,43 @@ async def lifespan(app: FastAPI):
         logger.info(f"Initializing stream processor for '{stream_id}'")
         processor = VideoStreamProcessor(config)
         stream_processors[stream_id] = processor
-        processor.start()
+        await processor.start()
         await asyncio.sleep(0.1) # Stagger startup slightly
         
-    # Start the background broadcast tasks
+    # Start the background broadcast task
     if stream_processors:
-        stream_broadcast_task = asyncio.create_task(stream_broadcast_loop())
-        analysis_broadcast_task = asyncio.create_task(analysis_broadcast_loop())
-        logger.info("Started background broadcast tasks.")
+        broadcast_task = asyncio.create_task(broadcast_loop())
+        logger.info("Started background broadcast task.")
     else:
-        logger.warning("No streams configured, broadcast tasks not started.")
+        logger.warning("No streams configured, broadcast task not started.")
 
     yield # Application runs here
     
+    warm_up_task.cancel()
+    
     # Shutdown
     logger.info("Application shutdown...")
-    if stream_broadcast_task:
-        stream_broadcast_task.cancel()
-        try:
-            await stream_broadcast_task
-        except asyncio.CancelledError:
-            logger.info("Stream broadcast task cancelled.")
-            
-    if analysis_broadcast_task:
-        analysis_broadcast_task.cancel()
+    if broadcast_task:
+        broadcast_task.cancel()
         try:
-            await analysis_broadcast_task
+            await broadcast_task
         except asyncio.CancelledError:
-            logger.info("Analysis broadcast task cancelled.")
+            logger.info("Broadcast task cancelled.")
             
     # Stop all stream processors
     for stream_id, processor in stream_processors.items():
         logger.info(f"Stopping stream processor for '{stream_id}'")
         processor.stop()
     
+    await close_http_clients()
     logger.info("Application shutdown complete.")
 
 # --- FastAPI Application ---
 app = FastAPI(
     title="Multi-Stream Accident Detector", 
     description="Real-time traffic accident detection and video streaming for multiple sources.",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse  # REST responses (e.g. base64 frames) are serialized with orjson too
 )
 
 # --- Add CORS Middleware --- 
@@ -212,8 +399,18 @@ app.add_middleware(
 # --- REST Endpoints ---
 @app.get("/")
 def health_check():
-    """Basic health check endpoint."""
-    return {"status": "ok", "streams_running": list(stream_processors.keys())}
+    """Basic health check endpoint, with vision model cache statistics overall and per stream."""
+    return {
+        "status": "ok",
+        "streams_running": list(stream_processors.keys()),
+        "vlm_cache": {"classification": classification_cache.stats(), "description": description_cache.stats()},
+        "streams": {stream_id: stream_health(stream_id, processor) for stream_id, processor in stream_processors.items()}
+    }
+
+def stream_health(stream_id, processor):
+    """A stream's processor counters plus the frames its connected video clients had to drop."""
+    clients = (*(active_connections.get(stream_id) or ()), *(combined_connections.get(stream_id) or ()))
+    return {**processor.stats(), "frames_dropped": sum(client.dropped for client in clients)}
 
 @app.get("/streams")
 def list_streams():
@@ -226,15 +423,28 @@ def list_streams():
     }
 
 @app.get("/stream/{stream_id}/frame")
-def get_latest_frame(stream_id: str):
-    """Get the latest frame for a specific stream as base64."""
+def get_latest_frame(stream_id: str, format: str = "json"):
+    """Get the latest frame for a specific stream as base64, or as a raw JPEG with `?format=jpeg`."""
     processor = get_stream_processor(stream_id)
-    frame_base64 = processor.get_latest_frame_base64()
+    if format == "jpeg":
+        frame_state = processor.get_latest_state()
+        if frame_state.jpeg is None:
+            raise HTTPException(status_code=404, detail=f"No frame available yet for stream '{stream_id}'.")
+        return Response(
+            content=frame_state.jpeg,
+            media_type="image/jpeg",
+            headers={"X-Stream-Id": stream_id, "X-Frame-Seq": str(frame_state.seq), "Cache-Control": "no-store"}
+        )
+    frame_time, _, frame_base64 = processor.get_latest()
     if frame_base64:
-        return {"stream_id": stream_id, "frame": frame_base64}
+        # Splice the frame's cached base64 into the body instead of running it through the JSON encoder per request
+        return Response(
+            content="".join(('{"stream_id":', orjson.dumps(stream_id).decode(), ',"frame":"', frame_base64, '"}')),
+            media_type="application/json"
+        )
     else:
         # Return 404 if no frame has ever been captured
-         if processor.latest_frame_time == 0:
+         if frame_time == 0:
               raise HTTPException(status_code=404, detail=f"No frame available yet for stream '{stream_id}'.")
          else: # Return 200 with null frame if frames were captured previously but not now
              return {"stream_id": stream_id, "frame": None, "message": "Frame currently unavailable"}
@@ -244,7 +454,11 @@ def get_latest_frame(stream_id: str):
 def get_latest_detection(stream_id: str):
     """Get the latest accident detection result for a specific stream."""
     processor = get_stream_processor(stream_id)
-    return {"stream_id": stream_id, "detection": processor.latest_detection_result}
+    # The detection JSON is encoded once per result change, not once per request
+    return Response(
+        content=b'{"stream_id":' + orjson.dumps(stream_id) + b',"detection":' + processor.get_latest_detection_json() + b'}',
+        media_type="application/json"
+    )
 
 # --- WebSocket Endpoints ---
 @app.websocket("/ws/stream/{stream_id}")
@@ -258,42 +472,32 @@ async def ws_stream_frames(ws: WebSocket, stream_id: str):
     await ws.accept()
     logger.info(f"Stream WebSocket connection established for stream '{stream_id}': {id(ws)}")
     
-    # Add to active connections for this stream
-    active_connections[stream_id].add(ws)
+    # Queue the initial frame immediately if available, then join the broadcast
+    client = FrameClient(ws, with_metadata=ws.query_params.get("format") == "msgpack")
+    processor = get_stream_processor(stream_id)
+    frame_state = processor.get_latest_state()
+    if frame_state.jpeg:
+        client.offer(frame_wire_payload(stream_id, frame_state) if client.with_metadata else frame_state.jpeg)
+    sender_task = asyncio.create_task(client.run_sender())
+    active_connections.add(stream_id, client)
+    processor.add_viewer()
     
     try:
-        # Send initial frame immediately if available
-        processor = get_stream_processor(stream_id)
-        frame_b64 = processor.get_latest_frame_base64()
-        if frame_b64:
-            await ws.send_json({
-                "type": "frame",
-                "stream_id": stream_id,
-                "frame": frame_b64,
-                "timestamp": datetime.datetime.utcnow().isoformat()
-            })
-        
-        # Keep the connection alive, waiting for messages or disconnect
-        while True:
-            # Simply wait for client messages or disconnect
-            # The stream_broadcast_loop handles sending frames
-            await ws.receive_text()
+        # Nothing to do until the client leaves; the client's sender task handles sending frames
+        await wait_for_disconnect(ws)
+        logger.info(f"Stream WebSocket connection closed for stream '{stream_id}': {id(ws)}")
     except WebSocketDisconnect:
         logger.info(f"Stream WebSocket connection closed for stream '{stream_id}': {id(ws)}")
     except Exception as e:
         logger.error(f"Error in stream WebSocket connection for stream '{stream_id}' ({id(ws)}): {e}")
     finally:
-        # Remove from active connections
-        if stream_id in active_connections:
-            active_connections[stream_id].discard(ws)
-            if not active_connections[stream_id]:
-                del active_connections[stream_id]
+        # Remove from active connections and stop the sender
+        sender_task.cancel()
+        active_connections.discard(stream_id, client)
+        processor.remove_viewer()
         
         # Ensure the connection is closed from server-side
-        try:
-            await ws.close()
-        except Exception:
-            pass
+        await close_if_open(ws)
 
 @app.websocket("/ws/analyze/{stream_id}")
 async def ws_stream_analysis(ws: WebSocket, stream_id: str):
@@ -307,38 +511,41 @@ async def ws_stream_analysis(ws: WebSocket, stream_id: str):
     logger.info(f"Analysis WebSocket connection established for stream '{stream_id}': {id(ws)}")
     
     # Add to analysis connections for this stream
-    analysis_connections[stream_id].add(ws)
+    use_msgpack = ws.query_params.get("format") == "msgpack"
+    if use_msgpack:
+        msgpack_analysis_connections.add(ws)
+    elif ws.query_params.get("frames") == "binary":
+        binary_frame_analysis_connections.add(ws)
+    analysis_connections.add(stream_id, ws)
     
     try:
         # Send initial status message
-        await ws.send_json({
+        status_message = {
             "type": "status", 
             "stream_id": stream_id,
             "message": "Connected to accident alert stream",
             "timestamp": time.time()
-        })
+        }
+        if use_msgpack:
+            await ws.send_bytes(encode_msgpack_message(status_message))
+        else:
+            await ws.send_text(encode_json_message(status_message))
         
-        # Keep the connection alive, waiting for messages or disconnect
-        while True:
-            # Simply wait for client messages or disconnect
-            # The analysis_broadcast_loop handles sending alerts
-            await ws.receive_text()
+        # Nothing to do until the client leaves; the broadcast_loop handles sending alerts
+        await wait_for_disconnect(ws)
+        logger.info(f"Analysis WebSocket connection closed for stream '{stream_id}': {id(ws)}")
     except WebSocketDisconnect:
         logger.info(f"Analysis WebSocket connection closed for stream '{stream_id}': {id(ws)}")
     except Exception as e:
         logger.error(f"Error in analysis WebSocket connection for stream '{stream_id}' ({id(ws)}): {e}")
     finally:
         # Remove from analysis connections
-        if stream_id in analysis_connections:
-            analysis_connections[stream_id].discard(ws)
-            if not analysis_connections[stream_id]:
-                del analysis_connections[stream_id]
+        msgpack_analysis_connections.discard(ws)
+        binary_frame_analysis_connections.discard(ws)
+        analysis_connections.discard(stream_id, ws)
         
         # Ensure the connection is closed from server-side
-        try:
-            await ws.close()
-        except Exception:
-            pass
+        await close_if_open(ws)
 
 # --- Legacy WebSocket Endpoint (for backward compatibility) ---
 @app.websocket("/ws/combined/{stream_id}")
@@ -349,30 +556,33 @@ async def ws_combined_stream(ws: WebSocket, stream_id: str):
         await ws.close(code=1008, reason=f"Unknown stream ID: {stream_id}")
         return
         
+    if not LEGACY_COMBINED_WS_ENABLED:
+        await ws.close(code=1008, reason="The combined endpoint is disabled; use /ws/stream and /ws/analyze")
+        return
+        
     await ws.accept()
     logger.info(f"Legacy combined WebSocket connection established for stream '{stream_id}': {id(ws)}")
     
+    # Queue the initial data immediately, then receive updates from the stream broadcast loop
+    client = FrameClient(ws, text=True)
+    processor = get_stream_processor(stream_id)
+    client.offer(combined_wire_payload(stream_id, processor))
+    sender_task = asyncio.create_task(client.run_sender())
+    combined_connections.add(stream_id, client)
+    processor.add_viewer()
+    
     try:
-        # Send initial data immediately if available
-        processor = get_stream_processor(stream_id)
-        initial_data = processor.get_latest_data()
-        await ws.send_text(json.dumps(initial_data))
-        
-        # Manually handle sending updates to this client
-        while True:
-            # Get latest data
-            data = processor.get_latest_data()
-            # Send update
-            await ws.send_text(json.dumps(data))
-            # Sleep to maintain reasonable frame rate (10 FPS)
-            await asyncio.sleep(0.1)
+        await wait_for_disconnect(ws)
+        logger.info(f"Legacy WebSocket connection closed for stream '{stream_id}': {id(ws)}")
     except WebSocketDisconnect:
         logger.info(f"Legacy WebSocket connection closed for stream '{stream_id}': {id(ws)}")
     except Exception as e:
         logger.error(f"Error in legacy WebSocket connection for stream '{stream_id}' ({id(ws)}): {e}")
     finally:
+        # Remove from combined connections and stop the sender
+        sender_task.cancel()
+        combined_connections.discard(stream_id, client)
+        processor.remove_viewer()
+        
         # Ensure the connection is closed from server-side
-        try:
-            await ws.close()
-        except Exception:
-            pass 
\ No newline at end of file
+        await close_if_open(ws) 
\ No newline at end of file
@@ -0,0 +1,39 @@
+import asyncio
+import time
+
+class TokenBucket:
+    """Client-side pacing for an API with requests-per-minute and tokens-per-minute limits.
+
+    Both budgets refill continuously at their per-minute rate, up to one minute's
+    worth. `acquire` waits until one request and the estimated number of tokens
+    are available, so calls are spread out instead of tripping provider 429s.
+    """
+
+    def __init__(self, rpm, tpm):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.request_tokens = float(rpm)
+        self.token_tokens = float(tpm)
+        self.last_update = time.monotonic()
+        self._lock = asyncio.Lock()  # Waiters are served in arrival order
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_update
+        self.last_update = now
+        self.request_tokens = min(self.rpm, self.request_tokens + elapsed * self.rpm / 60)
+        self.token_tokens = min(self.tpm, self.token_tokens + elapsed * self.tpm / 60)
+
+    async def acquire(self, estimated_tokens):
+        # A request larger than the whole budget would otherwise wait forever
+        estimated_tokens = min(estimated_tokens, self.tpm)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.request_tokens >= 1 and self.token_tokens >= estimated_tokens:
+                    self.request_tokens -= 1
+                    self.token_tokens -= estimated_tokens
+                    return
+                wait_request = max(0, (1 - self.request_tokens) * 60 / self.rpm)
+                wait_tokens = max(0, (estimated_tokens - self.token_tokens) * 60 / self.tpm)
+                await asyncio.sleep(max(wait_request, wait_tokens))
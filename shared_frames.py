@@ -0,0 +1,214 @@
+import fcntl
+import os
+import struct
+import tempfile
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+# Segment layout: a header followed by `slots` fixed-size slots
+#   header: latest_seq (u64), writer_pid (u32)
+#   slot:   seq (u64), length (u32), then up to `slot_size` payload bytes
+_HEADER = struct.Struct('<QI4x')
+_SLOT_HEADER = struct.Struct('<QI4x')
+_LATEST_SEQ = struct.Struct('<Q')  # The first header field, polled on its own
+# Per-ring writer locks live next to the segments themselves when possible
+_LOCK_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+class SharedRing:
+    """Single-writer, multi-reader ring of byte payloads in POSIX shared memory.
+
+    Each slot is guarded by its own sequence number (a seqlock): the writer zeroes it
+    before copying a payload in and sets it once the copy is complete, and a reader
+    discards any copy whose sequence number changed while it was reading.
+
+    Which process writes a ring is decided by an exclusive `flock` on a per-ring lock
+    file (see `create_or_attach`); the kernel releases it when the writer exits.
+    """
+
+    def __init__(self, shm, slots, slot_size, is_writer, lock_fd=None):
+        self._shm = shm
+        self._buf = shm.buf
+        self.slots = slots
+        self.slot_size = slot_size
+        self.is_writer = is_writer
+        self._lock_fd = lock_fd  # Held by the writer until close()
+        self._latest = self.latest_seq
+
+    @staticmethod
+    def segment_size(slots, slot_size):
+        return _HEADER.size + slots * (_SLOT_HEADER.size + slot_size)
+
+    @classmethod
+    def create(cls, name, slots, slot_size):
+        """Create the named ring as its writer, replacing any segment left under that name."""
+        _unlink(name)
+        shm = shared_memory.SharedMemory(name=name, create=True, size=cls.segment_size(slots, slot_size))
+        _HEADER.pack_into(shm.buf, 0, 0, os.getpid())
+        return cls(shm, slots, slot_size, is_writer=True)
+
+    @classmethod
+    def attach(cls, name, slots, slot_size):
+        """Attach to the named ring as a reader, or return None if it doesn't exist or doesn't fit."""
+        try:
+            shm = shared_memory.SharedMemory(name=name)
+        except (FileNotFoundError, ValueError):
+            # ValueError: the creator hasn't sized the segment yet, so there is nothing to map
+            return None
+        # Readers must not unlink the writer's segment when they exit
+        resource_tracker.unregister(shm._name, "shared_memory")
+        if shm.size < cls.segment_size(slots, slot_size):
+            shm.close()
+            return None
+        return cls(shm, slots, slot_size, is_writer=False)
+
+    @classmethod
+    def create_if_unowned(cls, name, slots, slot_size):
+        """Become the named ring's writer if no live process holds its writer lock, otherwise return None.
+
+        Any segment left under the name (e.g. by a writer that died) is replaced.
+        """
+        lock_fd = os.open(os.path.join(_LOCK_DIR, f"{name}.lock"), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(lock_fd)
+            return None
+        try:
+            ring = cls.create(name, slots, slot_size)
+        except BaseException:
+            os.close(lock_fd)
+            raise
+        ring._lock_fd = lock_fd
+        return ring
+
+    @classmethod
+    def create_or_attach(cls, name, slots, slot_size, attach_timeout=5.0):
+        """Become the named ring's writer, or attach as a reader if another live process already is.
+
+        A reader waits (with a short backoff) for the writer to finish initializing the
+        segment, and raises RuntimeError if it doesn't within `attach_timeout` seconds.
+        This blocks, so call it from a worker thread when running on an event loop.
+        """
+        deadline = time.monotonic() + attach_timeout
+        delay = 0.005
+        while True:
+            ring = cls.create_if_unowned(name, slots, slot_size)
+            if ring is not None:
+                return ring
+            ring = cls.attach(name, slots, slot_size)
+            # A zero or dead writer PID means the segment is still being set up (or is a stale one about to be replaced)
+            if ring is not None and not ring.is_stale():
+                return ring
+            if ring is not None:
+                ring.close()
+            if time.monotonic() >= deadline:
+                raise RuntimeError(f"Shared ring {name!r} has a writer that never finished initializing it")
+            time.sleep(delay)
+            delay = min(delay * 2, 0.2)
+
+    @property
+    def writer_pid(self):
+        return _HEADER.unpack_from(self._buf, 0)[1]
+
+    def is_stale(self):
+        """True if this ring's writer closed it or exited; a reader should then re-attach by name."""
+        return not _pid_alive(self.writer_pid)
+
+    @property
+    def latest_seq(self):
+        """Sequence number of the newest complete payload (0 if nothing was written yet)."""
+        return _LATEST_SEQ.unpack_from(self._buf, 0)[0]
+
+    def _slot_offset(self, seq):
+        return _HEADER.size + (seq % self.slots) * (_SLOT_HEADER.size + self.slot_size)
+
+    def write(self, *parts):
+        """Append one payload made of the concatenated `parts`. Returns False if it doesn't fit a slot."""
+        length = sum(len(part) for part in parts)
+        if length > self.slot_size:
+            return False
+        seq = self._latest + 1
+        offset = self._slot_offset(seq)
+        _SLOT_HEADER.pack_into(self._buf, offset, 0, 0)  # Mark the slot as being written
+        position = offset + _SLOT_HEADER.size
+        for part in parts:
+            self._buf[position:position + len(part)] = part
+            position += len(part)
+        _SLOT_HEADER.pack_into(self._buf, offset, seq, length)
+        _LATEST_SEQ.pack_into(self._buf, 0, seq)
+        self._latest = seq
+        return True
+
+    def read(self, seq):
+        """Return the payload written as `seq`, or None if it was overwritten or is being rewritten."""
+        offset = self._slot_offset(seq)
+        slot_seq, length = _SLOT_HEADER.unpack_from(self._buf, offset)
+        if slot_seq != seq:
+            return None
+        start = offset + _SLOT_HEADER.size
+        payload = bytes(self._buf[start:start + length])
+        if _SLOT_HEADER.unpack_from(self._buf, offset)[0] != seq:
+            return None
+        return payload
+
+    def read_prefixed(self, seq, prefix):
+        """Like `read`, for payloads starting with a `prefix` struct: returns `(fields, rest)` or None.
+
+        The rest of the payload is copied out of shared memory once, rather than copied
+        whole and then sliced again.
+        """
+        offset = self._slot_offset(seq)
+        slot_seq, length = _SLOT_HEADER.unpack_from(self._buf, offset)
+        if slot_seq != seq or length < prefix.size:
+            return None
+        start = offset + _SLOT_HEADER.size
+        fields = prefix.unpack_from(self._buf, start)
+        rest = bytes(self._buf[start + prefix.size:start + length])
+        if _SLOT_HEADER.unpack_from(self._buf, offset)[0] != seq:
+            return None
+        return fields, rest
+
+    def read_since(self, last_seq):
+        """Return `(latest_seq, payloads)` for everything written after `last_seq` that is still in the ring."""
+        latest = self.latest_seq
+        first = max(last_seq + 1, latest - self.slots + 1)
+        payloads = []
+        for seq in range(first, latest + 1):
+            payload = self.read(seq)
+            if payload is not None:
+                payloads.append(payload)
+        return latest, payloads
+
+    def close(self):
+        """Detach from the segment; the writer also removes it."""
+        if self.is_writer:
+            # Readers still mapping the unlinked segment see it as stale and re-attach by name
+            _HEADER.pack_into(self._buf, 0, self._latest, 0)
+        self._buf = None
+        self._shm.close()
+        if self.is_writer:
+            # A reader sharing this process's resource tracker (e.g. a sibling uvicorn worker) may have
+            # unregistered the segment; re-register so unlink()'s own unregister finds it
+            resource_tracker.register(self._shm._name, "shared_memory")
+            self._shm.unlink()
+        if self._lock_fd is not None:
+            # Unlinked first, so a worker taking over never sees this writer's segment as live
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+def _pid_alive(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def _unlink(name):
+    try:
+        shared_memory.SharedMemory(name=name).unlink()
+    except FileNotFoundError:
+        pass
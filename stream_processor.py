@@ -1,17 +1,31 @@
 import os
+import asyncio
 import subprocess
-import base64
+import selectors
+import fcntl
+import pybase64
+import hashlib
+import struct
+import gzip
 import time
 import threading
-import requests
-import json
+import atexit
+import orjson
+import re
 import logging
-import datetime
-from pathlib import Path
-import urllib.request
+import logging.handlers
+import queue
 import random
-from together import Together
-from queue import Queue, Empty
+import cv2
+import httpx
+import numpy as np
+import msgpack
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from detection_cache import ResponseCache, PerceptualHashCache, MotionGate, grayscale_thumbnail, perceptual_hash
+from shared_frames import SharedRing
+from rate_limiter import TokenBucket
 
 # --- Logging Setup ---
 log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -31,21 +45,61 @@ logger.setLevel(logging.INFO)
 logger.addHandler(console_handler)
 logger.propagate = False # Prevent double logging in root logger
 
-# Specific logger for accidents
+# Specific logger for accidents. Records are only enqueued by the analysis tasks; a listener
+# thread formats and writes them, so the file write and flush stay off the event loop.
+accident_log_queue = queue.SimpleQueue()
+accident_log_listener = logging.handlers.QueueListener(
+    accident_log_queue, accident_log_handler, console_handler # Also log accidents to console
+)
+accident_log_listener.start()
+atexit.register(accident_log_listener.stop) # Flushes queued records on exit
+
 accident_logger = logging.getLogger("AccidentLog")
 accident_logger.setLevel(logging.INFO)
-accident_logger.addHandler(accident_log_handler)
-accident_logger.addHandler(console_handler) # Also log accidents to console
+accident_logger.addHandler(logging.handlers.QueueHandler(accident_log_queue))
 accident_logger.propagate = False
 
 # --- Together AI Client & Prompts ---
-together_client = Together(api_key=os.environ.get("TOGETHER_API_KEY"))
+TOGETHER_API_URL = "https://api.together.xyz/v1/chat/completions"
+TOGETHER_MODELS_URL = "https://api.together.xyz/v1/models"  # Cheap request used to warm up the connection
+TOGETHER_API_KEY = os.environ.get("TOGETHER_API_KEY")
+VISION_MODEL = "meta-llama/Llama-3.2-11B-Vision-Instruct-Turbo"
+# Gzip request bodies (level 1). Opt-in: only enable if the endpoint accepts Content-Encoding: gzip
+TOGETHER_GZIP_REQUESTS = os.environ.get("TOGETHER_GZIP_REQUESTS", "0") == "1"
+
+# Cap on vision model requests in flight across all streams (each stream also has its own analysis_concurrency)
+MAX_CONCURRENT_VLM_REQUESTS = int(os.environ.get("MAX_CONCURRENT_VLM_REQUESTS", "8"))
+vlm_request_slots = asyncio.Semaphore(MAX_CONCURRENT_VLM_REQUESTS)
 
+# Optional client-side pacing shared by every stream (set both to your Together account's limits)
+TOGETHER_RPM = int(os.environ.get("TOGETHER_RPM", "0"))
+TOGETHER_TPM = int(os.environ.get("TOGETHER_TPM", "0"))
+together_rate_limiter = TokenBucket(TOGETHER_RPM, TOGETHER_TPM) if TOGETHER_RPM > 0 and TOGETHER_TPM > 0 else None
+
+# Shared async HTTP/2 client so overlapping VLM requests reuse the same keep-alive pool.
+# Every request body is pre-serialized JSON, so the headers are fixed for the client's lifetime.
+# The connection is kept for 60 s when idle (httpx defaults to 5 s): while the motion gate or the
+# caches answer every frame, no request may be sent for a while, and reconnecting costs a TLS handshake.
+together_http_client = httpx.AsyncClient(
+    headers={"Authorization": f"Bearer {TOGETHER_API_KEY}", "Content-Type": "application/json"},
+    # An explicit transport so failed connection attempts are retried (twice) before a request fails;
+    # pooling and HTTP/2 are configured on it since the client's own settings don't apply to it
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        limits=httpx.Limits(max_connections=16, max_keepalive_connections=8, keepalive_expiry=60.0),
+        retries=2,
+    ),
+    timeout=httpx.Timeout(30.0, connect=2.0),  # Fail fast on connect; inference itself can be slow
+)
+
+# Classifies and, for accidents, describes the scene in a single call
 CLASSIFICATION_PROMPT = (
     "You are an automated traffic monitoring system. Classify the attached image based ONLY on whether a vehicle accident is visible. "
     "Traffic cameras rarely capture accidents - most views show normal traffic flow. Only identify an accident when there is clear evidence "
     "of a collision, vehicle damage, or unusual positioning of vehicles on the road. "
-    "Respond with exactly one word: 'accident' or 'safe'."
+    "If no accident is visible, respond with exactly one word: 'SAFE'. "
+    "If an accident is visible, respond with 'ACCIDENT: ' followed by a brief, factual description (under 10 words) of the vehicles involved, "
+    "the collision type and the time of day based on lighting, e.g. 'ACCIDENT: Daytime: Two sedans collide at an intersection.'"
 )
 DESCRIPTION_PROMPT = (
 '''You are an automated traffic monitoring system. An accident has been detected in the attached image.  
@@ -67,6 +121,72 @@ Few-Shot Examples of expected outputs:
 - **Morning: Blue pickup rear-ended silver sedan.**'''
 )
 
+# Derived from the prompt text so any prompt edit invalidates cached classifications
+CLASSIFICATION_PROMPT_VERSION = hashlib.sha256(CLASSIFICATION_PROMPT.encode('utf-8')).hexdigest()[:12]
+DESCRIPTION_PROMPT_VERSION = hashlib.sha256(DESCRIPTION_PROMPT.encode('utf-8')).hexdigest()[:12]
+
+# How vision model responses are cached: "enabled" (read and write), "replay" (answer only from
+# the cache, never call the model) or "disabled" (always call the model, store nothing)
+VLM_CACHE_POLICY = os.environ.get("VLM_CACHE_POLICY", "enabled")
+if VLM_CACHE_POLICY not in ("enabled", "replay", "disabled"):
+    logger.warning(f"Unknown VLM_CACHE_POLICY '{VLM_CACHE_POLICY}', using 'enabled'")
+    VLM_CACHE_POLICY = "enabled"
+
+# Frames sent to the vision model are downscaled to fit this size (Llama-3.2 Vision tile size)
+VISION_IMAGE_SIZE = 672
+VISION_JPEG_PARAMS = [
+    int(cv2.IMWRITE_JPEG_QUALITY), 70,
+    int(cv2.IMWRITE_JPEG_OPTIMIZE), 0,
+    int(cv2.IMWRITE_JPEG_PROGRESSIVE), 0
+]
+if "libjpeg-turbo" not in cv2.getBuildInformation():
+    logger.warning("OpenCV is not built with libjpeg-turbo; JPEG re-encoding for the vision model will be slower.")
+# pybase64 picks a SIMD kernel (AVX2/AVX512/NEON) at import; without its C extension it is no faster than stdlib base64
+if "C extension active" not in pybase64.get_version():
+    logger.warning(f"pybase64 C extension is not active ({pybase64.get_version()}); base64 encoding of frames will be slower.")
+
+# Fast path for pulling the reply text out of a chat completion response. Only matches
+# escape-free content; anything else falls back to a full JSON parse.
+RESPONSE_CONTENT_PATTERN = re.compile(rb'"content"\s*:\s*"([^"\\]*)"')
+
+# JPEG start/end-of-image markers used to split ffmpeg's MJPEG pipe output
+JPEG_SOI = b'\xff\xd8'
+JPEG_EOI = b'\xff\xd9'
+FFMPEG_READ_SIZE = 1 << 20  # Max bytes read from an ffmpeg pipe at once
+VIDEO_FPS = 30  # Frame rate extracted for video clients
+IDLE_FPS_GRACE_PERIOD = 30.0  # Seconds after the last video client leaves before extraction slows to idle_fps
+# Hardware video decoding for HLS streams ("auto" picks NVDEC/VAAPI/VideoToolbox/... when available and
+# silently decodes in software otherwise; "none" always decodes in software)
+FFMPEG_HWACCEL = os.environ.get("FFMPEG_HWACCEL", "auto")
+FFMPEG_HWACCEL_ARGS = [] if FFMPEG_HWACCEL == "none" else ["-hwaccel", FFMPEG_HWACCEL]
+
+# --- Multi-worker frame sharing ---
+# With several uvicorn workers, SHARED_FRAMES=1 lets the first worker to claim a stream capture and analyze it,
+# publishing frames and analysis messages through shared memory; the other workers mirror them.
+SHARED_FRAMES = os.environ.get("SHARED_FRAMES", "0") == "1"
+SHARED_FRAME_SLOTS = 3
+SHARED_FRAME_SLOT_SIZE = 1024 * 1024
+SHARED_MESSAGE_SLOTS = 8
+SHARED_MESSAGE_SLOT_SIZE = 512 * 1024
+SHARED_FRAME_TIME = struct.Struct('<d')  # Capture time stored in front of each shared JPEG
+MIRROR_STALL_AFTER = 1.0  # Seconds without a new shared frame before mirroring polls less often
+MIRROR_STALLED_POLL_INTERVAL = 0.1
+MIRROR_TAKEOVER_CHECK_INTERVAL = 1.0  # How often a stalled mirror checks whether the capturing worker is gone
+
+# CPU-bound frame work (JPEG decode/resize/re-encode, thumbnails) runs on its own bounded pool instead of
+# the event loop, so analysis of several streams never delays frame broadcasts or other executor users
+DETECTOR_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("DETECTOR_WORKERS", "4")), thread_name_prefix="detector"
+)
+atexit.register(DETECTOR_EXECUTOR.shutdown)
+# Frames are processed in parallel across the detector threads, so OpenCV's own per-call thread pool
+# would only oversubscribe the CPU (each resize fanning out to every core from every detector thread)
+cv2.setNumThreads(1)
+
+# Outcome of recent M3U8 URL validations: url -> (monotonic time checked, valid)
+URL_VALIDITY_TTL = 300.0
+_url_validity = {}
+
 # --- Fallback Sources --- (Used if stream_config['url'] == 'fallback')
 FALLBACK_SOURCES = [
     "https://511ev.org/cameras/CAM106/latest.jpg",
@@ -75,6 +195,221 @@ FALLBACK_SOURCES = [
     "https://traffic.511mn.org/cameras/CAM112/latest.jpg"
 ]
 
+def build_vision_request(prompt, max_tokens, temperature):
+    """Pre-serialize a single-image chat request around an image placeholder.
+
+    Returns `(prefix, suffix)` bytes; the request body for a frame is
+    `prefix + base64_jpeg_bytes + suffix`, so no per-call JSON encoding is needed.
+    """
+    placeholder = "__IMAGE_BASE64__"
+    body = orjson.dumps({
+        "model": VISION_MODEL,
+        "messages": [
+            {"role": "user", "content": [
+                {"type": "text", "text": prompt},
+                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{placeholder}"}}
+            ]}
+        ],
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "stream": False
+    })
+    prefix, suffix = body.split(placeholder.encode('ascii'))
+    return prefix, suffix
+
+CLASSIFICATION_REQUEST = build_vision_request(CLASSIFICATION_PROMPT, max_tokens=120, temperature=0.1)  # Low temp for classification; room for a description
+DESCRIPTION_REQUEST = build_vision_request(DESCRIPTION_PROMPT, max_tokens=100, temperature=0.7)  # Higher temp for creative description
+# Rough tokens per call charged against TOGETHER_TPM, counted the same way for every request:
+# the image, the prompt (about 4 characters per token) and the full reply budget
+VISION_IMAGE_TOKEN_ESTIMATE = 340
+
+def estimate_vision_tokens(prompt, max_tokens):
+    return VISION_IMAGE_TOKEN_ESTIMATE + len(prompt) // 4 + max_tokens
+
+CLASSIFICATION_TOKEN_ESTIMATE = estimate_vision_tokens(CLASSIFICATION_PROMPT, max_tokens=120)  # About 630
+DESCRIPTION_TOKEN_ESTIMATE = estimate_vision_tokens(DESCRIPTION_PROMPT, max_tokens=100)  # About 700
+
+# libjpeg can decode at 1/2, 1/4 or 1/8 scale, skipping most of the IDCT work for pixels we'd discard anyway
+REDUCED_DECODE_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+def jpeg_dimensions(jpeg_bytes):
+    """Read `(width, height)` from a JPEG's frame header without decoding it, or None if not found."""
+    i = 2  # Skip SOI
+    while i + 9 <= len(jpeg_bytes):
+        if jpeg_bytes[i] != 0xFF:
+            return None
+        marker = jpeg_bytes[i + 1]
+        if marker == 0xFF:  # Fill byte
+            i += 1
+            continue
+        # SOFn markers (except DHT, JPG and DAC, which share the range) carry the image size
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack_from('>HH', jpeg_bytes, i + 5)
+            return width, height
+        i += 2 + struct.unpack_from('>H', jpeg_bytes, i + 2)[0]
+    return None
+
+def prepare_vision_image(jpeg_bytes):
+    """Downscale a JPEG to fit VISION_IMAGE_SIZE and re-encode it at a lower quality.
+
+    Returns the original bytes if the frame is already small enough or cannot be decoded.
+    """
+    decode_flag = cv2.IMREAD_COLOR
+    dimensions = jpeg_dimensions(jpeg_bytes)
+    if dimensions:
+        longest = max(dimensions)
+        if longest <= VISION_IMAGE_SIZE:
+            return jpeg_bytes
+        # Decode at the smallest scale that is still at least VISION_IMAGE_SIZE, then resize the rest of the way
+        for factor, flag in REDUCED_DECODE_FLAGS:
+            if longest // factor >= VISION_IMAGE_SIZE:
+                decode_flag = flag
+                break
+    img = cv2.imdecode(np.frombuffer(jpeg_bytes, dtype=np.uint8), decode_flag)
+    if img is None:
+        return jpeg_bytes
+    height, width = img.shape[:2]
+    scale = VISION_IMAGE_SIZE / max(height, width)
+    if scale >= 1:
+        return jpeg_bytes
+    # Keep the aspect ratio so vehicles aren't distorted
+    img = cv2.resize(img, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+    ok, encoded = cv2.imencode('.jpg', img, VISION_JPEG_PARAMS)
+    return encoded.tobytes() if ok else jpeg_bytes
+
+# Recently encoded frames as (source JPEG, base64 of the prepared image), matched by object identity.
+# An accident frame is classified and then described, so the description reuses the classification's encoding.
+_vision_image_cache = deque(maxlen=16)
+
+def encode_vision_image(jpeg_bytes):
+    """Return the base64 bytes sent to the vision model for a frame, preparing each frame object only once."""
+    for source, encoded in tuple(_vision_image_cache):  # Snapshot: detector threads append concurrently
+        if source is jpeg_bytes:
+            return encoded
+    # Smaller JPEG -> less base64, smaller body, faster upload.
+    # b64encode returns bytes, which go straight into the body without a str round-trip
+    encoded = pybase64.b64encode(prepare_vision_image(jpeg_bytes))
+    _vision_image_cache.append((jpeg_bytes, encoded))
+    return encoded
+
+def build_vision_body(request_template, img_bytes):
+    """Fill a pre-serialized request template with a frame, returning the exact bytes to POST."""
+    prefix, suffix = request_template
+    body = b"".join((prefix, encode_vision_image(img_bytes), suffix))  # One copy of the image payload rather than two
+    if TOGETHER_GZIP_REQUESTS:
+        # Level 1 is cheap and recovers most of the base64 and JSON overhead on the wire
+        body = gzip.compress(body, compresslevel=1)
+    return body
+
+async def vision_completion(request_template, img_bytes, estimated_tokens):
+    """Send a JPEG to the Together vision model using a pre-built request template and return the reply text."""
+    # The whole body (image preparation, base64, splicing and gzip) is built off the event loop
+    body = await asyncio.get_running_loop().run_in_executor(DETECTOR_EXECUTOR, build_vision_body, request_template, img_bytes)
+    if together_rate_limiter is not None:
+        await together_rate_limiter.acquire(estimated_tokens)
+    async with vlm_request_slots:
+        response = await together_http_client.post(
+            TOGETHER_API_URL, content=body, headers={"Content-Encoding": "gzip"} if TOGETHER_GZIP_REQUESTS else None
+        )
+    response.raise_for_status()
+    return parse_completion_content(response.content)
+
+def parse_completion_content(response_body):
+    """Extract the first choice's message text from a raw chat completion response body."""
+    match = RESPONSE_CONTENT_PATTERN.search(response_body)
+    if match:
+        return match.group(1).decode('utf-8').strip()
+    return orjson.loads(response_body)["choices"][0]["message"]["content"].strip()
+
+async def warm_up_vision_client():
+    """Open the TLS/HTTP2 connection to Together ahead of the first classification."""
+    try:
+        start_time = time.monotonic()
+        await together_http_client.get(TOGETHER_MODELS_URL)
+        logger.info(f"Together API connection warmed up in {time.monotonic() - start_time:.2f}s")
+    except Exception as e:
+        logger.warning(f"Could not warm up Together API connection: {e}")
+
+# The vision model takes one image per request, so each frame goes out as soon as it's ready;
+# concurrent requests from all streams are multiplexed over the shared HTTP/2 connection
+async def _classify_frame(img_bytes):
+    return await vision_completion(CLASSIFICATION_REQUEST, img_bytes, CLASSIFICATION_TOKEN_ESTIMATE)
+
+async def _describe_frame(img_bytes):
+    return await vision_completion(DESCRIPTION_REQUEST, img_bytes, DESCRIPTION_TOKEN_ESTIMATE)
+
+def parse_classification(text):
+    """Split a classification reply into `(result, description)`; description is None unless the model gave one."""
+    text = text.strip().strip("*").strip()  # The model sometimes wraps its answer in markdown bold
+    if text.upper().startswith("ACCIDENT"):
+        _, _, description = text.partition(":")
+        return "accident", description.strip() or None
+    return ("safe", None) if "safe" in text.lower() else ("accident", None)
+
+# Classifications and accident descriptions keyed by (model, prompt version, SHA-256 of the JPEG bytes)
+classification_cache = ResponseCache(maxsize=1024, ttl=60.0)
+description_cache = ResponseCache(maxsize=256, ttl=60.0)
+
+# Shared keep-alive client for polling fallback cameras (one HTTP/2 connection per host).
+# Idle connections are kept for 60 s (httpx defaults to 5 s) so slow or retrying polls don't redo TCP/TLS setup.
+fallback_http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=32, max_keepalive_connections=32, keepalive_expiry=60.0),
+    timeout=3.0
+)
+
+async def sleep_until_next(next_wake, interval):
+    """Sleep until `interval` after the previous wake-up time and return the new wake-up time.
+
+    Scheduling against absolute times keeps the cadence from drifting with work time and
+    sleep jitter. A slightly late tick runs immediately and keeps its place on the schedule; once
+    more than a whole interval behind, the missed ticks are dropped and the schedule restarts from now.
+    """
+    next_wake += interval
+    now = time.monotonic()
+    if next_wake < now - interval:
+        return now
+    if next_wake > now:
+        await asyncio.sleep(next_wake - now)
+    return next_wake
+
+_iso_second = None
+_iso_second_prefix = None
+
+def iso_timestamp(ts):
+    """Format epoch seconds like `datetime.utcnow().isoformat()`, formatting the date/time part once per second."""
+    global _iso_second, _iso_second_prefix
+    second = int(ts)
+    if second != _iso_second:
+        # time.strftime skips building a datetime (and utcfromtimestamp is deprecated since Python 3.12)
+        _iso_second_prefix = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(second))
+        _iso_second = second
+    return f"{_iso_second_prefix}.{int((ts - second) * 1_000_000):06d}"
+
+async def close_http_clients():
+    """Close the shared HTTP clients (called on application shutdown)."""
+    await together_http_client.aclose()
+    await fallback_http_client.aclose()
+
+@dataclass(slots=True)
+class FrameState:
+    """One published frame. A new instance replaces the old one on every frame, so readers
+    holding a reference always see a consistent seq/time/bytes/base64 combination."""
+    seq: int = 0
+    captured_at: float = 0  # Epoch seconds, 0 if no frame yet
+    jpeg: bytes = None
+    b64: str = None  # Filled in lazily by the first base64 consumer
+
+    def base64(self):
+        if self.b64 is None and self.jpeg is not None:
+            # Racing callers encode the same bytes, so whichever assignment wins is correct
+            self.b64 = pybase64.b64encode_as_string(self.jpeg)
+        return self.b64
+
 class VideoStreamProcessor:
     def __init__(self, stream_config):
         self.config = stream_config
@@ -82,17 +417,43 @@ class VideoStreamProcessor:
         self.location = stream_config['location']
         self.stream_url = stream_config['url']
         self.analysis_interval = 1.0 / stream_config['analysis_fps']
+        # Max number of VLM requests allowed in flight at once for this stream
+        self.analysis_concurrency = stream_config.get('analysis_concurrency', 2)
+        # Seconds to wait for a classification before reusing the previous result
+        self.analysis_timeout = stream_config.get('analysis_timeout', 5.0)
         # For backward compatibility - stream_fps is now fixed at 30 FPS
         self.stream_interval = 1.0 / 30.0  # Fixed 30 FPS for all streams
-        self.frames_dir = Path(f"frames/{self.stream_id}")
-        self.current_frame_path = self.frames_dir / "current_frame.jpg"
-
-        self.frames_dir.mkdir(parents=True, exist_ok=True)
+        # Without video viewers, ffmpeg only needs to produce frames at the analysis rate. Not with
+        # SHARED_FRAMES: viewers connected to other workers are invisible to the capturing worker.
+        self.idle_fps = stream_config.get('idle_fps', stream_config['analysis_fps'])
+        self._reduce_fps_when_idle = stream_config.get('reduce_fps_when_idle', True) and not SHARED_FRAMES
+        self._viewers = 0
+        self._idle_fps_handle = None
+        self._output_fps = self.idle_fps if self._reduce_fps_when_idle else VIDEO_FPS
+        self._ffmpeg_restart = False
+        # JPEG quality of extracted frames (ffmpeg -q:v, 2 = best/largest ... 31 = worst/smallest)
+        self.jpeg_qscale = stream_config.get('jpeg_qscale', 5)
+        # Optional output width in pixels (height follows the aspect ratio); None keeps the source size
+        self.frame_width = stream_config.get('frame_width')
 
-        self.latest_frame_base64 = None
-        self.latest_frame_time = 0
+        # Latest frame as one FrameState snapshot. The producer swaps the reference on every new
+        # frame (atomic under the GIL), so readers never lock, stat or read a file.
+        self._frame_lock = threading.Lock()  # Serializes producers only
+        self._frame_state = FrameState()
+        # Latest-frame-only handoff to each consumer: the producer overwrites, consumers popleft, nothing ever blocks
+        self._analysis_frames = deque(maxlen=1)
+        # The video broadcast reads _frame_state directly and remembers the last seq it sent
+        self._broadcast_seq = 0
+        # Wakes the analysis loop when a frame lands in _analysis_frames
+        self._analysis_frame_ready = asyncio.Event()
+        # Wakes the video broadcast when a new frame is published
+        self.new_frame_event = asyncio.Event()
+        self._loop = None
         
-        # For backward compatibility
+        # For backward compatibility. Always replaced or changed through _set_detection_description,
+        # which drops the cached JSON encoding and bumps detection_version
+        self._latest_detection_json = None
+        self.detection_version = 0
         self.latest_detection_result = {
             "status": "initializing",
             "result": "safe",
@@ -102,67 +463,153 @@ class VideoStreamProcessor:
         }
         
         self.use_fallback_source = (self.stream_url == 'fallback')
-        self.fallback_index = 0
+        self._fallback_tasks = []
 
-        # New queue-based system
-        self.analysis_queue = Queue()
-        self.broadcast_queue = Queue()
+        # Analysis runs as asyncio tasks; the semaphore bounds overlapping VLM requests.
+        # Messages for analysis clients are appended and drained on the event loop only, so a plain
+        # deque needs no locking; it is bounded because nothing drains it while no client is connected.
+        self.broadcast_queue = deque(maxlen=256)
         self.analysis_clients = set()
-        self.analyze_threads = []
+        self._analysis_slots = asyncio.Semaphore(self.analysis_concurrency)
+        self._analysis_tasks = set()
+        # Recent classifications of this camera's scene, matched by perceptual hash
+        self._phash_cache = PerceptualHashCache(capacity=32, max_distance=8)
+        self._description_phash_cache = PerceptualHashCache(capacity=8, max_distance=8)
+        # Reuses the last classification while the scene stays static (e.g. an empty highway at night)
+        self._motion_gate = MotionGate(
+            threshold=stream_config.get('motion_threshold', 2.0),
+            quiet_frames=stream_config.get('motion_quiet_frames', 3),
+            max_skips=stream_config.get('motion_max_skips', 10),
+            max_age=stream_config.get('motion_max_age', 30.0)
+        )
+        self._analysis_seq = 0  # Numbers dispatched frames so the motion gate can order their results
         
         self._stop_event = threading.Event()
         self._frame_extractor_thread = None
-        self._analysis_feed_thread = None
+        self._source_task = None  # Validates the M3U8 URL, then starts ffmpeg or fallback polling
+        self._analysis_loop_task = None
         self._ffmpeg_process = None
 
-    def _validate_m3u8_url(self):
+        # Shared-memory rings when SHARED_FRAMES is on: written if this worker captures the stream, read otherwise
+        self._shared_frames = None
+        self._shared_messages = None
+        self._shared_lock = threading.Lock()  # Frames and messages are published from different threads
+        self._mirror_task = None
+
+    async def _validate_m3u8_url(self):
         if self.use_fallback_source:
             return False # No URL to validate for fallback
+        # Restarts within the TTL reuse the last outcome instead of waiting on another request
+        checked_at, valid = _url_validity.get(self.stream_url, (0, None))
+        if time.monotonic() - checked_at < URL_VALIDITY_TTL:
+            return valid
         try:
             # More lenient validation - just check if URL returns any valid response
             headers = {
                 'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.114 Safari/537.36'
             }
-            response = requests.get(self.stream_url, headers=headers, timeout=5)
+            # Through the shared async client: no blocked thread and no one-off TCP/TLS connection.
+            # HEAD skips downloading the playlist; servers that don't support it get a GET instead
+            response = await fallback_http_client.head(self.stream_url, headers=headers, timeout=3, follow_redirects=True)
+            if response.status_code in (405, 501):
+                response = await fallback_http_client.get(self.stream_url, headers=headers, timeout=3, follow_redirects=True)
             logger.info(f"[{self.stream_id}] M3U8 URL validation status: {response.status_code}")
             # Accept any 2xx or 3xx status code as valid
-            return response.status_code < 400
+            valid = response.status_code < 400
         except Exception as e:
             logger.error(f"[{self.stream_id}] Error validating M3U8 URL '{self.stream_url}': {e}")
-            return False
+            valid = False
+        _url_validity[self.stream_url] = (time.monotonic(), valid)
+        return valid
 
-    def _get_fallback_frame(self):
-        source = FALLBACK_SOURCES[self.fallback_index % len(FALLBACK_SOURCES)]
-        self.fallback_index += 1
-        try:
-            url = f"{source}?nocache={int(time.time())}"
-            urllib.request.urlretrieve(url, self.current_frame_path)
-            return True
-        except Exception as e:
-            logger.error(f"[{self.stream_id}] Error downloading fallback frame: {e}")
-            return False
+    def add_viewer(self):
+        """Register a video client; ffmpeg switches to the full frame rate for the first one."""
+        self._viewers += 1
+        if self._idle_fps_handle is not None:
+            self._idle_fps_handle.cancel()
+            self._idle_fps_handle = None
+        self._set_output_fps(VIDEO_FPS)
+
+    def remove_viewer(self):
+        """Unregister a video client; ffmpeg drops to `idle_fps` once none is left for a grace period."""
+        self._viewers = max(self._viewers - 1, 0)
+        if self._viewers == 0 and self._reduce_fps_when_idle and self._loop is not None:
+            # Brief gaps (page reloads, reconnects) shouldn't restart ffmpeg twice
+            self._idle_fps_handle = self._loop.call_later(IDLE_FPS_GRACE_PERIOD, self._set_output_fps, self.idle_fps)
+
+    def _set_output_fps(self, fps):
+        """Change ffmpeg's output frame rate, restarting a running ffmpeg with the new rate."""
+        self._idle_fps_handle = None
+        if fps == self._output_fps:
+            return
+        logger.info(f"[{self.stream_id}] Switching frame extraction to {fps} FPS ({self._viewers} video client(s)).")
+        self._output_fps = fps
+        process = self._ffmpeg_process
+        if process is not None:
+            self._ffmpeg_restart = True
+            process.terminate()
 
     def _run_ffmpeg(self):
+        """Run ffmpeg until the processor stops or ffmpeg fails, restarting it whenever the output frame rate changes"""
+        while not self._stop_event.is_set():
+            self._ffmpeg_restart = False
+            self._run_ffmpeg_once(self._output_fps)
+            if not self._ffmpeg_restart:
+                break
+
+    def _run_ffmpeg_once(self, fps):
+        # VIDEO_FPS while clients watch the stream, idle_fps otherwise; optionally downscaled
+        video_filter = f"fps={fps}"
+        if self.frame_width:
+            video_filter += f",scale={self.frame_width}:-2"
         cmd = [
             "ffmpeg",
             "-hide_banner", "-loglevel", "error", # Reduce verbosity
             "-headers", "User-Agent: Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36",
             "-protocol_whitelist", "file,http,https,tcp,tls",
+            # Low-latency input: emit frames as soon as they're decoded instead of buffering segments
+            "-fflags", "nobuffer+discardcorrupt",
+            "-flags", "low_delay",
+            "-avioflags", "direct",
+            "-rtbufsize", "100M",
+            "-probesize", "500000", "-analyzeduration", "500000", # Small, but enough to find the H.264 stream parameters
+            "-max_delay", "0",
+            "-tcp_nodelay", "1",
+            *FFMPEG_HWACCEL_ARGS,
             "-i", self.stream_url,
-            "-vf", f"fps={30}", # Fixed 30 FPS for stream endpoint
-            "-q:v", "2",
-            "-update", "1",
-            "-y", str(self.current_frame_path)
+            "-an", "-sn", "-dn", # Video only: don't demux or decode audio, subtitle or data tracks
+            "-vf", video_filter,
+            "-vsync", "passthrough",
+            "-flush_packets", "1", # Write each JPEG to the pipe immediately
+            "-f", "image2pipe", "-vcodec", "mjpeg", # Stream JPEGs to stdout instead of a file on disk
+            "-pix_fmt", "yuvj420p", # 4:2:0 chroma: smaller JPEGs than 4:4:4 sources would give
+            "-q:v", str(self.jpeg_qscale),
+            "pipe:1"
         ]
         logger.info(f"[{self.stream_id}] Starting ffmpeg: {' '.join(cmd)}")
         try:
             # Start the process without waiting for it to complete
-            self._ffmpeg_process = subprocess.Popen(cmd, stderr=subprocess.PIPE)
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            self._ffmpeg_process = process
+            if fps != self._output_fps:
+                # The rate changed while ffmpeg was starting; start over with the new one
+                self._ffmpeg_restart = True
+                process.terminate()
+            if hasattr(fcntl, "F_SETPIPE_SZ"):
+                try:
+                    # Linux pipes hold 64 KB by default, less than one frame: ffmpeg would block
+                    # several times per JPEG waiting for us to read. Let the pipe hold whole frames.
+                    fcntl.fcntl(process.stdout.fileno(), fcntl.F_SETPIPE_SZ, FFMPEG_READ_SIZE)
+                except OSError as e:
+                    logger.debug(f"[{self.stream_id}] Could not enlarge the ffmpeg pipe: {e}")
 
-            # Monitor the process in case it exits unexpectedly
-            stderr_output = self._ffmpeg_process.communicate()[1] # Wait and get stderr
-            if self._ffmpeg_process.returncode != 0 and not self._stop_event.is_set():
-                 logger.error(f"[{self.stream_id}] ffmpeg process exited unexpectedly with code {self._ffmpeg_process.returncode}. Error: {stderr_output.decode('utf-8', errors='ignore')}")
+            recent_errors = self._read_ffmpeg_output(process) # Blocks until ffmpeg closes both pipes (exits)
+            process.wait()
+            stderr_output = b"".join(recent_errors)
+            if self._ffmpeg_restart:
+                pass # Terminated on purpose to change the frame rate
+            elif process.returncode != 0 and not self._stop_event.is_set():
+                 logger.error(f"[{self.stream_id}] ffmpeg process exited unexpectedly with code {process.returncode}. Error: {stderr_output.decode('utf-8', errors='ignore')}")
                  self.use_fallback_source = True # Attempt to switch to fallback
             elif not self._stop_event.is_set():
                 logger.warning(f"[{self.stream_id}] ffmpeg process exited cleanly but unexpectedly.")
@@ -173,172 +620,511 @@ class VideoStreamProcessor:
              self._ffmpeg_process = None # Clear process handle
              logger.info(f"[{self.stream_id}] ffmpeg process stopped.")
 
-    def _fallback_loop(self):
-        logger.info(f"[{self.stream_id}] Starting fallback frame loop.")
+    def _read_ffmpeg_output(self, process):
+        """Publish the JPEGs ffmpeg writes to stdout while draining its stderr, both from this thread.
+
+        Returns ffmpeg's last few stderr lines for error reporting.
+        """
+        stdout_fd = process.stdout.fileno()
+        recent_errors = deque(maxlen=20)
+        stderr_pending = b""
+        buffer = bytearray()
+        scan_from = 0 # Where to resume searching for EOI in the current frame
+        with selectors.DefaultSelector() as selector:
+            selector.register(stdout_fd, selectors.EVENT_READ)
+            selector.register(process.stderr.fileno(), selectors.EVENT_READ)
+            while selector.get_map():
+                for key, _ in selector.select():
+                    # Raw reads of up to 1 MB: several frames per syscall when the reader falls behind
+                    chunk = os.read(key.fd, FFMPEG_READ_SIZE)
+                    if not chunk:
+                        selector.unregister(key.fd)
+                    elif key.fd == stdout_fd:
+                        buffer += chunk
+                        scan_from = self._publish_mjpeg_frames(buffer, scan_from)
+                    else:
+                        # Drain stderr as it arrives so a full pipe never blocks ffmpeg
+                        *lines, stderr_pending = (stderr_pending + chunk).split(b"\n")
+                        for line in lines:
+                            logger.debug(f"[{self.stream_id}] ffmpeg: {line.decode('utf-8', errors='ignore')}")
+                            recent_errors.append(line + b"\n")
+        if stderr_pending:
+            recent_errors.append(stderr_pending)
+        return recent_errors
+
+    def _publish_mjpeg_frames(self, buffer, scan_from):
+        """Split complete JPEGs off the front of `buffer` on SOI/EOI markers and publish them.
+
+        Returns the offset to resume searching for EOI from once more data arrives.
+        """
+        while True:
+            soi = buffer.find(JPEG_SOI)
+            if soi < 0:
+                # Keep a trailing 0xFF in case the marker is split across reads
+                del buffer[:-1]
+                return 0
+            eoi = buffer.find(JPEG_EOI, max(soi + 2, scan_from))
+            if eoi < 0:
+                del buffer[:soi]
+                return max(len(buffer) - 1, 0)
+            # Copy the frame out once through a view (slicing the bytearray first would copy it twice);
+            # the view must be released before the buffer is resized
+            with memoryview(buffer) as view:
+                frame = bytes(view[soi:eoi + 2])
+            self._publish_frame(frame)
+            del buffer[:eoi + 2]
+            scan_from = 0
+
+    def _publish_frame(self, jpeg_bytes, captured_at=None):
+        """Make a new JPEG the latest frame (called from the frame extractor threads)"""
+        with self._frame_lock:
+            self._frame_state = FrameState(self._frame_state.seq + 1, captured_at or time.time(), jpeg_bytes)
+            if self._shared_frames is not None:
+                with self._shared_lock:
+                    ring = self._shared_frames  # Re-read under the lock: stop() may have released it
+                    if ring is not None and ring.is_writer:
+                        # Frames larger than a slot are simply not shared
+                        ring.write(SHARED_FRAME_TIME.pack(self._frame_state.captured_at), jpeg_bytes)
+            self._analysis_frames.append(jpeg_bytes)
+        # asyncio events aren't thread-safe, so hand the wakeup to the event loop
+        if not self._stop_event.is_set():
+            self._loop.call_soon_threadsafe(self._signal_new_frame)
+
+    def _signal_new_frame(self):
+        self._analysis_frame_ready.set()
+        self.new_frame_event.set()
+
+    async def _fallback_source_loop(self, source):
+        """Poll one fallback camera, publishing a frame only when its image changes"""
+        logger.info(f"[{self.stream_id}] Starting fallback polling for {source}.")
+        validators = {}
+        next_wake = time.monotonic()
         while not self._stop_event.is_set():
-            if not self._get_fallback_frame():
-                logger.warning(f"[{self.stream_id}] Failed to get fallback frame, retrying...")
-            time.sleep(1.0 / 30.0)  # 30 FPS for consistent streaming
-        logger.info(f"[{self.stream_id}] Fallback frame loop stopped.")
+            # Spread the stream's frame rate (30 FPS while watched, idle_fps otherwise) across all sources;
+            # conditional requests make unchanged images a cheap 304
+            interval = len(FALLBACK_SOURCES) / self._output_fps
+            try:
+                response = await fallback_http_client.get(source, headers=validators)
+                if response.status_code == 200:
+                    self._publish_frame(response.content)
+                    validators = {}
+                    if "ETag" in response.headers:
+                        validators["If-None-Match"] = response.headers["ETag"]
+                    if "Last-Modified" in response.headers:
+                        validators["If-Modified-Since"] = response.headers["Last-Modified"]
+                elif response.status_code != 304:
+                    logger.warning(f"[{self.stream_id}] Fallback source {source} returned status {response.status_code}, retrying...")
+            except Exception as e:
+                logger.error(f"[{self.stream_id}] Error downloading fallback frame from {source}: {e}")
+
+            next_wake = await sleep_until_next(next_wake, interval)
+        logger.info(f"[{self.stream_id}] Fallback polling for {source} stopped.")
 
     def _start_frame_extraction_thread(self):
-        # Only use fallback if explicitly configured that way
         if self.use_fallback_source:
-            logger.warning(f"[{self.stream_id}] Using fallback image source.")
-            self._frame_extractor_thread = threading.Thread(target=self._fallback_loop, daemon=True)
+            self._start_fallback_polling()
         else:
-            # Try ffmpeg directly without validation - let ffmpeg handle connectivity
-            logger.info(f"[{self.stream_id}] Using M3U8 stream source: {self.stream_url}")
-            self._frame_extractor_thread = threading.Thread(target=self._run_ffmpeg, daemon=True)
-        
+            # Check the playlist URL before launching ffmpeg (at most once per URL_VALIDITY_TTL)
+            self._source_task = asyncio.get_running_loop().create_task(self._start_m3u8_source())
+
+    def _start_fallback_polling(self):
+        logger.warning(f"[{self.stream_id}] Using fallback image source.")
+        # Poll every fallback source concurrently on the event loop
+        loop = asyncio.get_running_loop()
+        self._fallback_tasks = [loop.create_task(self._fallback_source_loop(source)) for source in FALLBACK_SOURCES]
+
+    async def _start_m3u8_source(self):
+        if not await self._validate_m3u8_url():
+            # An unreachable playlist would only make ffmpeg fail after its own timeouts
+            logger.warning(f"[{self.stream_id}] M3U8 URL failed validation: {self.stream_url}")
+            self.use_fallback_source = True
+            self._start_fallback_polling()
+            return
+        if self._stop_event.is_set():
+            return
+        logger.info(f"[{self.stream_id}] Using M3U8 stream source: {self.stream_url}")
+        self._frame_extractor_thread = threading.Thread(target=self._run_ffmpeg, daemon=True)
         self._frame_extractor_thread.start()
 
-    def _periodically_feed_analysis(self):
-        """Feed frames to the analysis queue at regular intervals"""
-        logger.info(f"[{self.stream_id}] Starting analysis feed loop (interval: {self.analysis_interval:.2f}s).")
-        while not self._stop_event.is_set():
-            start_time = time.monotonic()
-            frame_b64 = self.get_latest_frame_base64()
-            if frame_b64:
-                # Only add if queue isn't too large to prevent memory issues
-                if self.analysis_queue.qsize() < 5:
-                    self.analysis_queue.put(frame_b64)
-            
-            # Calculate sleep time to maintain desired analysis feed rate
-            elapsed = time.monotonic() - start_time
-            sleep_time = max(0, self.analysis_interval - elapsed)
-            time.sleep(sleep_time)
-        logger.info(f"[{self.stream_id}] Analysis feed loop stopped.")
-
-    def _analyze_worker(self):
-        """Worker thread that processes frames from the analysis queue"""
-        logger.info(f"[{self.stream_id}] Starting analysis worker thread.")
+    async def _analysis_loop(self):
+        """Dispatch new frames for analysis at most every analysis interval, overlapping in-flight VLM requests"""
+        logger.info(f"[{self.stream_id}] Starting analysis loop (interval: {self.analysis_interval:.2f}s, concurrency: {self.analysis_concurrency}).")
+        next_wake = time.monotonic()
         while not self._stop_event.is_set():
-            try:
-                # Get frame with timeout to allow checking stop_event periodically
-                try:
-                    frame_b64 = self.analysis_queue.get(timeout=1.0)
-                except Empty:
-                    continue
-
-                # --- START SIMULATION --- 
-                # Temporarily bypass actual detection for testing
-                # Perform accident detection
-                result = self.detect_accident(frame_b64)
-                # result = "accident" if random.random() < 0.01 else "safe"
-                # --- END SIMULATION ---
-
-                # Update legacy detection result for backward compatibility
-                current_time = datetime.datetime.utcnow().isoformat()
-                self.latest_detection_result = {
-                    "status": "success",
-                    "result": result,
-                    "description": None,
-                    "timestamp": current_time,
-                    "location": self.location
-                }
-                
-                # Create and send classification update message regardless of result
-                classification_message = {
+            # Wait for a free slot first so the freshest frame is dispatched, not one queued behind a slow call
+            await self._analysis_slots.acquire()
+            # Then wait for a frame that hasn't been analyzed yet (no polling while the source is stalled)
+            await self._analysis_frame_ready.wait()
+            self._analysis_frame_ready.clear()
+            frame_bytes = self.next_frame_for_analysis()
+            if frame_bytes:
+                frame_digest = hashlib.sha256(frame_bytes).hexdigest()
+                self._analysis_seq += 1
+                # The motion gate is consulted here, in frame order, rather than by the concurrent analysis tasks
+                thumbnail = await asyncio.get_running_loop().run_in_executor(DETECTOR_EXECUTOR, grayscale_thumbnail, frame_bytes)
+                static = (thumbnail is not None and self.latest_detection_result["status"] == "success"
+                          and self._motion_gate.is_static(thumbnail))
+                task = asyncio.create_task(
+                    self._analyze_frame(frame_bytes, frame_digest, thumbnail, self._analysis_seq, static)
+                )
+                self._analysis_tasks.add(task)
+                task.add_done_callback(self._on_analysis_done)
+            else:
+                self._analysis_slots.release()
+
+            # Keep the configured analysis rate
+            next_wake = await sleep_until_next(next_wake, self.analysis_interval)
+        logger.info(f"[{self.stream_id}] Analysis loop stopped.")
+
+    def _on_analysis_done(self, task):
+        self._analysis_tasks.discard(task)
+        self._analysis_slots.release()
+
+    async def _analyze_frame(self, frame_bytes, frame_digest, thumbnail, seq, static):
+        """Classify a single JPEG frame (or reuse the last result if `static`) and broadcast the results"""
+        try:
+            frame_phash = None
+            if static:
+                # Nothing has moved since the last classification: keep it without calling the model
+                result, description, available = (
+                    self.latest_detection_result["result"], self.latest_detection_result["description"], True
+                )
+            else:
+                # Perform accident detection (accidents come back already described)
+                frame_phash = perceptual_hash(thumbnail) if thumbnail is not None else None
+                result, description, available = await self.detect_accident(frame_bytes, frame_digest, frame_phash)
+                if available and thumbnail is not None:
+                    self._motion_gate.classified(seq, thumbnail)
+
+            now = time.time()
+            current_time = iso_timestamp(now)
+
+            if not available:
+                # Classification timed out: report the previous result as unavailable and skip the update
+                self._emit_message({
                     "type": "classification_update",
                     "stream_id": self.stream_id,
                     "timestamp": current_time,
+                    "ts": now,
                     "result": result,
+                    "available": False,
                     "location": self.location
+                })
+                return
+
+            # Update legacy detection result for backward compatibility
+            self.latest_detection_result = {
+                "status": "success",
+                "result": result,
+                "description": description if static else None,
+                "timestamp": current_time,
+                "location": self.location
+            }
+            
+            # Create and send classification update message regardless of result
+            classification_message = {
+                "type": "classification_update",
+                "stream_id": self.stream_id,
+                "timestamp": current_time,
+                "ts": now,
+                "result": result,
+                "available": True,
+                "location": self.location
+            }
+            self._emit_message(classification_message)
+            
+            # If accident detected, broadcast an alert with its description (once: a reused result was already alerted)
+            if result == "accident" and not static:
+                if not description:
+                    # The model flagged an accident without describing it: ask separately
+                    description = await self.describe_accident(frame_bytes, frame_digest, frame_phash)
+                self._set_detection_description(description)
+                
+                # Create message for analysis clients
+                message = {
+                    "type": "accident_alert",
+                    "stream_id": self.stream_id,
+                    "timestamp": current_time,
+                    "ts": now,
+                    "location": self.location,
+                    "description": description,
+                    "frame": frame_bytes  # Raw JPEG of the frame that triggered the alert, base64'd only for JSON clients
                 }
-                self.broadcast_queue.put(classification_message)
                 
-                # If accident detected, get description and broadcast alert
-                if result == "accident":
-                    description = self.describe_accident(frame_b64)
-                    self.latest_detection_result["description"] = description
-                    
-                    # Create message for analysis clients
-                    message = {
-                        "type": "accident_alert",
-                        "stream_id": self.stream_id,
-                        "timestamp": current_time,
-                        "location": self.location,
-                        "description": description,
-                        "frame": frame_b64  # Include the frame that triggered the alert
-                    }
-                    
-                    # Add to broadcast queue
-                    self.broadcast_queue.put(message)
-                    
-                    # Log the accident
-                    accident_logger.info(f"Accident Detected - Stream: {self.stream_id}, Location: {self.location}, Time: {current_time}, Description: {description}")
+                # Add to broadcast queue
+                self._emit_message(message)
                 
-            except Exception as e:
-                logger.error(f"[{self.stream_id}] Error in analysis worker: {e}", exc_info=True)
-        
-        logger.info(f"[{self.stream_id}] Analysis worker thread stopped.")
+                # Log the accident
+                accident_logger.info(f"Accident Detected - Stream: {self.stream_id}, Location: {self.location}, Time: {current_time}, Description: {description}")
+            
+        except Exception as e:
+            logger.error(f"[{self.stream_id}] Error analyzing frame: {e}", exc_info=True)
+
+    def _emit_message(self, message):
+        """Queue a message for this worker's analysis clients and share it with the other workers."""
+        self.broadcast_queue.append(message)
+        if self._shared_messages is not None:
+            with self._shared_lock:
+                ring = self._shared_messages
+                if ring is not None and not ring.write(msgpack.packb(message, use_bin_type=True)):
+                    logger.warning(f"[{self.stream_id}] {message['type']} message too large to share with other workers")
+
+    @property
+    def is_capturing(self):
+        """True if this worker captures and analyzes the stream itself (always, unless SHARED_FRAMES mirrors it)."""
+        return self._shared_frames is None or self._shared_frames.is_writer
+
+    @property
+    def _shared_ring_name(self):
+        return "cdb_" + re.sub(r'[^A-Za-z0-9_]', '_', self.stream_id)
+
+    def _attach_shared_rings(self):
+        """Claim the stream for this worker, or attach to the worker that already captures it."""
+        ring_name = self._shared_ring_name
+        self._shared_frames = SharedRing.create_or_attach(f"{ring_name}_frames", SHARED_FRAME_SLOTS, SHARED_FRAME_SLOT_SIZE)
+        if self._shared_frames.is_writer:
+            self._shared_messages = SharedRing.create(f"{ring_name}_messages", SHARED_MESSAGE_SLOTS, SHARED_MESSAGE_SLOT_SIZE)
+
+    def _take_over_capture(self):
+        """Start capturing the stream in this worker if its capturing worker has exited. Returns True if it did."""
+        ring_name = self._shared_ring_name
+        frames = SharedRing.create_if_unowned(f"{ring_name}_frames", SHARED_FRAME_SLOTS, SHARED_FRAME_SLOT_SIZE)
+        if frames is None:
+            return False  # The writer lock is still held: the capturing worker is alive, just not producing frames
+        logger.warning(f"[{self.stream_id}] Capturing worker {self._shared_frames.writer_pid} is gone; taking over capture.")
+        with self._shared_lock:
+            for ring in (self._shared_frames, self._shared_messages):
+                if ring is not None:
+                    ring.close()
+            self._shared_frames = frames
+            self._shared_messages = SharedRing.create(f"{ring_name}_messages", SHARED_MESSAGE_SLOTS, SHARED_MESSAGE_SLOT_SIZE)
+        self._mirror_task = None  # Called from the mirror loop, which returns right after
+        self._start_capturing()
+        return True
+
+    def _reattach_shared_frames(self):
+        """Switch to the frame ring currently published under this stream's name. Returns True if it did.
+
+        The message ring is dropped too; the mirror loop attaches the new writer's one.
+        """
+        frames = SharedRing.attach(f"{self._shared_ring_name}_frames", SHARED_FRAME_SLOTS, SHARED_FRAME_SLOT_SIZE)
+        if frames is None or frames.is_stale():
+            if frames is not None:
+                frames.close()
+            return False  # The new writer hasn't replaced the segment yet
+        logger.info(f"[{self.stream_id}] Mirroring stream from worker {frames.writer_pid} via shared memory.")
+        with self._shared_lock:
+            for ring in (self._shared_frames, self._shared_messages):
+                if ring is not None:
+                    ring.close()
+            self._shared_frames = frames
+            self._shared_messages = None
+        return True
+
+    async def _mirror_loop(self):
+        """Republish frames and analysis messages from the worker that captures this stream."""
+        logger.info(f"[{self.stream_id}] Mirroring stream from worker {self._shared_frames.writer_pid} via shared memory.")
+        ring_name = self._shared_ring_name
+        frame_seq = max(self._shared_frames.latest_seq - 1, 0)  # Start from the current frame
+        message_seq = None
+        next_attach_at = 0
+        last_frame_at = time.monotonic()
+        next_takeover_check = last_frame_at + MIRROR_TAKEOVER_CHECK_INTERVAL
+        while not self._stop_event.is_set():
+            now = time.monotonic()  # One clock read per poll
+            latest_frame_seq = self._shared_frames.latest_seq
+            if latest_frame_seq != frame_seq:
+                last_frame_at = now
+                # Only the newest frame matters; skipped frames would be stale by now
+                shared_frame = self._shared_frames.read_prefixed(latest_frame_seq, SHARED_FRAME_TIME)
+                frame_seq = latest_frame_seq
+                if shared_frame is not None:
+                    (captured_at,), jpeg_bytes = shared_frame
+                    self._publish_frame(jpeg_bytes, captured_at)
+
+            if self._shared_messages is None:
+                # The capturing worker creates its message ring just after the frame ring. Each attempt
+                # opens and maps the segment, so retry at most once a second rather than on every poll.
+                if now >= next_attach_at:
+                    next_attach_at = now + 1.0
+                    messages = SharedRing.attach(f"{ring_name}_messages", SHARED_MESSAGE_SLOTS, SHARED_MESSAGE_SLOT_SIZE)
+                    if messages is not None and messages.writer_pid == self._shared_frames.writer_pid:
+                        self._shared_messages = messages
+                        message_seq = messages.latest_seq
+                    elif messages is not None:
+                        messages.close()
+            else:
+                message_seq, payloads = self._shared_messages.read_since(message_seq)
+                for payload in payloads:
+                    self._apply_mirrored_message(msgpack.unpackb(payload, raw=False))
 
-    def detect_accident(self, img_b64):
-        """Detect if an accident is present in the image."""
+            # Poll several times per frame while frames flow; back off once the capture has stalled
+            if now - last_frame_at < MIRROR_STALL_AFTER:
+                await asyncio.sleep(self.stream_interval / 4)
+            else:
+                if now >= next_takeover_check:
+                    next_takeover_check = now + MIRROR_TAKEOVER_CHECK_INTERVAL
+                    if self._take_over_capture():
+                        logger.info(f"[{self.stream_id}] Mirror loop stopped (now capturing).")
+                        return
+                    if self._shared_frames.is_stale() and self._reattach_shared_frames():
+                        # Another worker took over (or the capturing worker restarted): follow its new rings
+                        frame_seq = max(self._shared_frames.latest_seq - 1, 0)
+                        message_seq = None
+                        next_attach_at = 0
+                await asyncio.sleep(MIRROR_STALLED_POLL_INTERVAL)
+        logger.info(f"[{self.stream_id}] Mirror loop stopped.")
+
+    def _apply_mirrored_message(self, message):
+        """Queue a message from the capturing worker and keep this worker's detection result in sync."""
+        self.broadcast_queue.append(message)
+        if message["type"] == "classification_update" and message["available"]:
+            self.latest_detection_result = {
+                "status": "success",
+                "result": message["result"],
+                "description": None,
+                "timestamp": message["timestamp"],
+                "location": self.location
+            }
+        elif message["type"] == "accident_alert":
+            self._set_detection_description(message["description"])
+
+    async def detect_accident(self, img_bytes, img_digest=None, img_phash=None):
+        """Detect if an accident is present in the image, describing it if so.
+
+        Returns `(result, description, available)`; `description` is None for safe frames
+        (and for accidents the model didn't describe). `available` is False when the model
+        did not answer within `analysis_timeout` and the previous result is returned instead.
+        Byte-identical frames (`img_digest`) and near-duplicate frames (`img_phash`)
+        are answered from cache without calling the model (see VLM_CACHE_POLICY).
+        """
+        use_cache = VLM_CACHE_POLICY != "disabled"
+        cache_key = (VISION_MODEL, CLASSIFICATION_PROMPT_VERSION, img_digest) if img_digest and use_cache else None
+        if cache_key:
+            cached = classification_cache.get(cache_key)
+            if cached is not None:
+                return (*cached, True)
+        if img_phash is not None and use_cache:
+            cached = self._phash_cache.get(img_phash)
+            if cached is not None:
+                return (*cached, True)
+        if VLM_CACHE_POLICY == "replay":
+            return self.latest_detection_result["result"], None, False
         try:
-            response = together_client.chat.completions.create(
-                model="meta-llama/Llama-3.2-11B-Vision-Instruct-Turbo",
-                messages=[
-                    {"role": "user", "content": [
-                        {"type": "text", "text": CLASSIFICATION_PROMPT},
-                        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{img_b64}"}}
-                    ]}
-                ],
-                max_tokens=15,
-                temperature=0.1,  # Low temp for classification
-                stream=False
-            )
-            classification_text = response.choices[0].message.content.strip().lower()
-            return "safe" if "safe" in classification_text else "accident"
+            try:
+                classification_text = await asyncio.wait_for(_classify_frame(img_bytes), self.analysis_timeout)
+            except asyncio.TimeoutError:
+                # The late request is cancelled, freeing its slot for the next frame
+                return self.latest_detection_result["result"], None, False
+            classification = parse_classification(classification_text)
+            if cache_key:
+                classification_cache.put(cache_key, classification)
+            if img_phash is not None and use_cache and classification[0] == "safe":
+                # Only safe scenes are matched approximately; a frame that merely resembles an
+                # accident frame is always checked by the model
+                self._phash_cache.put(img_phash, classification)
+            return (*classification, True)
         except Exception as e:
             logger.error(f"[{self.stream_id}] Error during accident detection: {e}")
-            return "safe"  # Default to safe on error
+            return "safe", None, True  # Default to safe on error
 
-    def describe_accident(self, img_b64):
-        """Generate a description for a detected accident."""
+    async def describe_accident(self, img_bytes, img_digest=None, img_phash=None):
+        """Generate a description for a detected accident, reusing cached descriptions like `detect_accident`."""
+        use_cache = VLM_CACHE_POLICY != "disabled"
+        cache_key = (VISION_MODEL, DESCRIPTION_PROMPT_VERSION, img_digest) if img_digest and use_cache else None
+        if cache_key:
+            cached = description_cache.get(cache_key)
+            if cached is not None:
+                return cached
+        if img_phash is not None and use_cache:
+            cached = self._description_phash_cache.get(img_phash)
+            if cached is not None:
+                return cached
+        if VLM_CACHE_POLICY == "replay":
+            return "Description unavailable (not cached)."
         try:
-            desc_response = together_client.chat.completions.create(
-                model="meta-llama/Llama-3.2-11B-Vision-Instruct-Turbo",
-                messages=[
-                    {"role": "user", "content": [
-                        {"type": "text", "text": DESCRIPTION_PROMPT},
-                        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{img_b64}"}}
-                    ]}
-                ],
-                max_tokens=100,
-                temperature=0.7,  # Higher temp for creative description
-                stream=False
-            )
-            return desc_response.choices[0].message.content.strip()
+            description = await _describe_frame(img_bytes)
+            if cache_key:
+                description_cache.put(cache_key, description)
+            if img_phash is not None and use_cache:
+                self._description_phash_cache.put(img_phash, description)
+            return description
         except Exception as e:
             logger.error(f"[{self.stream_id}] Error getting accident description: {e}")
             return "Error generating description."
 
-    def get_latest_frame_base64(self):
+    def next_frame_for_analysis(self):
+        """Pop the newest frame not yet analyzed, or None if no new frame arrived."""
         try:
-            if not self.current_frame_path.exists():
-                # Return last known frame if current doesn't exist yet
-                return self.latest_frame_base64 
-
-            mod_time = self.current_frame_path.stat().st_mtime
-
-            # Check if frame is new
-            if mod_time > self.latest_frame_time:
-                with open(self.current_frame_path, "rb") as img_file:
-                    frame_data = img_file.read()
-                    self.latest_frame_base64 = base64.b64encode(frame_data).decode('utf-8')
-                    self.latest_frame_time = mod_time
-            
-            # Return the latest frame (could be old or new)
-            return self.latest_frame_base64
+            return self._analysis_frames.popleft()
+        except IndexError:
+            return None
 
-        except FileNotFoundError:
-             logger.warning(f"[{self.stream_id}] Frame file not found: {self.current_frame_path}")
-             return self.latest_frame_base64 # Return last known frame
-        except Exception as e:
-            logger.error(f"[{self.stream_id}] Error getting current frame: {e}")
-            return self.latest_frame_base64 # Return last known frame
+    def next_frame_for_broadcast(self):
+        """Return the newest FrameState if it wasn't broadcast to video clients yet, otherwise None.
+
+        Several publishes can share one wakeup; frames published in between are skipped, never queued.
+        """
+        frame_state = self._frame_state  # One atomic read of the latest slot
+        if frame_state.seq == self._broadcast_seq:
+            return None
+        self._broadcast_seq = frame_state.seq
+        return frame_state
+
+    @property
+    def frame_seq(self):
+        """Number of frames published so far; changes whenever a new frame arrives."""
+        return self._frame_state.seq
+
+    @property
+    def latest_frame_time(self):
+        """Capture time (epoch seconds) of the latest frame, 0 if none yet."""
+        return self._frame_state.captured_at
+
+    def get_latest_state(self):
+        """Return the latest FrameState (its `jpeg` is None if no frame yet)."""
+        return self._frame_state
+
+    def get_latest(self):
+        """Return `(capture_time, jpeg_bytes, base64)` of the latest frame, all from the same frame."""
+        state = self._frame_state
+        return state.captured_at, state.jpeg, state.base64()
+
+    def get_latest_frame_bytes(self):
+        """Return the latest frame as raw JPEG bytes (None if no frame yet)."""
+        return self._frame_state.jpeg
+
+    def get_latest_frame_base64(self):
+        """Return the latest frame as base64, encoding each frame at most once."""
+        return self._frame_state.base64()
+
+    @property
+    def latest_detection_result(self):
+        return self._latest_detection_result
+
+    @latest_detection_result.setter
+    def latest_detection_result(self, result):
+        self._latest_detection_result = result
+        self._latest_detection_json = None
+        self.detection_version += 1
+
+    def _set_detection_description(self, description):
+        self._latest_detection_result["description"] = description
+        self._latest_detection_json = None
+        self.detection_version += 1
+
+    def get_latest_detection_json(self):
+        """Return `latest_detection_result` as JSON bytes, encoded once per change."""
+        if self._latest_detection_json is None:
+            self._latest_detection_json = orjson.dumps(self._latest_detection_result)
+        return self._latest_detection_json
+
+    def get_latest_data_json(self):
+        """Return `get_latest_data()` as JSON text, reusing the frame's cached base64 and the cached detection JSON."""
+        frame_base64 = self.get_latest_frame_base64()
+        # Built as a str in one join: the base64 (the bulk of the message) is copied exactly once
+        frame_json = ('"', frame_base64, '"') if frame_base64 else ('null',)
+        return "".join(('{"frame":', *frame_json, ',"detection":', self.get_latest_detection_json().decode(), '}'))
 
     def get_latest_data(self):
         """Returns the latest frame and detection data combined (for backward compatibility)."""
@@ -347,36 +1133,47 @@ class VideoStreamProcessor:
             "detection": self.latest_detection_result
         }
 
-    def start_analysis_workers(self, num_threads=2):
-        """Start multiple analysis worker threads."""
-        for i in range(num_threads):
-            thread = threading.Thread(target=self._analyze_worker, daemon=True)
-            thread.start()
-            self.analyze_threads.append(thread)
-            logger.info(f"[{self.stream_id}] Started analysis worker thread #{i+1}")
+    def stats(self):
+        """Per-stream counters for the health check."""
+        return {
+            "phash_cache": self._phash_cache.stats(),
+            "description_phash_cache": self._description_phash_cache.stats(),
+            "motion_skipped": self._motion_gate.skipped
+        }
 
-    def start(self):
+    async def start(self):
         logger.info(f"[{self.stream_id}] Starting video stream processor...")
         self._stop_event.clear()
+        self._loop = asyncio.get_running_loop()
         
+        if SHARED_FRAMES:
+            # Attaching may wait for another worker to finish setting up the rings; keep the event loop free meanwhile
+            await self._loop.run_in_executor(None, self._attach_shared_rings)
+        if not self.is_capturing:
+            # Another worker captures and analyzes this stream; just mirror its output
+            self._mirror_task = self._loop.create_task(self._mirror_loop())
+            logger.info(f"[{self.stream_id}] Video stream processor started (mirroring).")
+            return
+        self._start_capturing()
+        logger.info(f"[{self.stream_id}] Video stream processor started.")
+
+    def _start_capturing(self):
         # Start frame extraction
         self._start_frame_extraction_thread()
         
-        # Give frame extractor a moment to start
-        time.sleep(1)
-        
-        # Start analysis feed thread
-        self._analysis_feed_thread = threading.Thread(target=self._periodically_feed_analysis, daemon=True)
-        self._analysis_feed_thread.start()
-        
-        # Start analysis worker threads
-        self.start_analysis_workers(2)  # Start 2 worker threads
-        
-        logger.info(f"[{self.stream_id}] Video stream processor started.")
+        # Start analysis loop on the running event loop (it waits for the first frame itself)
+        self._analysis_loop_task = self._loop.create_task(self._analysis_loop())
 
     def stop(self):
         logger.info(f"[{self.stream_id}] Stopping video stream processor...")
         self._stop_event.set()
+        if self._idle_fps_handle is not None:
+            self._idle_fps_handle.cancel()
+            self._idle_fps_handle = None
+
+        if self._source_task:
+            self._source_task.cancel()
+            self._source_task = None
 
         # Stop ffmpeg process if running
         if self._ffmpeg_process:
@@ -392,33 +1189,31 @@ class VideoStreamProcessor:
             finally:
                  self._ffmpeg_process = None
 
+        # Cancel fallback polling tasks
+        for task in self._fallback_tasks:
+            task.cancel()
+        self._fallback_tasks = []
+
         # Wait for threads to finish
         if self._frame_extractor_thread and self._frame_extractor_thread.is_alive():
             logger.debug(f"[{self.stream_id}] Waiting for frame extractor thread...")
             self._frame_extractor_thread.join(timeout=5)
         
-        if self._analysis_feed_thread and self._analysis_feed_thread.is_alive():
-            logger.debug(f"[{self.stream_id}] Waiting for analysis feed thread...")
-            self._analysis_feed_thread.join(timeout=5)
-        
-        # Wait for all analysis worker threads
-        for i, thread in enumerate(self.analyze_threads):
-            if thread.is_alive():
-                logger.debug(f"[{self.stream_id}] Waiting for analysis worker thread #{i+1}...")
-                thread.join(timeout=5)
+        # Cancel the analysis loop and any in-flight VLM requests
+        if self._analysis_loop_task:
+            self._analysis_loop_task.cancel()
+            self._analysis_loop_task = None
+        for task in list(self._analysis_tasks):
+            task.cancel()
+
+        # Stop mirroring and release the shared-memory rings (the capturing worker also removes them)
+        if self._mirror_task:
+            self._mirror_task.cancel()
+            self._mirror_task = None
+        with self._shared_lock:
+            for ring in (self._shared_frames, self._shared_messages):
+                if ring is not None:
+                    ring.close()
+            self._shared_frames = self._shared_messages = None
         
         logger.info(f"[{self.stream_id}] Video stream processor stopped.")
-
-# Cleanup function to delete old frame directories (optional)
-def cleanup_frame_dirs(base_dir="frames"):
-     base_path = Path(base_dir)
-     if base_path.exists():
-         for item in base_path.iterdir():
-             if item.is_dir():
-                 try:
-                     # Basic cleanup: remove the directory and its contents
-                     # In a real scenario, might want more sophisticated cleanup
-                     # shutil.rmtree(item)
-                     logger.info(f"Would delete frame directory: {item}") # Placeholder
-                 except Exception as e:
-                     logger.error(f"Error cleaning up directory {item}: {e}") 
\ No newline at end of file
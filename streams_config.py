@@ -5,6 +5,16 @@
 # - url: The M3U8 URL or 'fallback' to use the static fallback images.
 # - location: A human-readable description of the camera location.
 # - analysis_fps: How many times per second to run accident *detection* (e.g., 1).
+# - analysis_concurrency (optional): Vision model requests this stream may have in flight at once (default 2).
+# - analysis_timeout (optional): Seconds to wait for a classification before reporting it unavailable (default 5.0).
+# - motion_threshold (optional): Mean per-pixel change from the last classified frame below which the scene counts as static (default 2.0).
+# - motion_quiet_frames (optional): Consecutive static frames before the last classification is reused (default 3).
+# - motion_max_skips (optional): Reused classifications before the model is called again anyway (default 10).
+# - motion_max_age (optional): Seconds after which a static scene is classified again anyway (default 30.0).
+# - reduce_fps_when_idle (optional): Extract frames at only idle_fps while no video client is connected (default True; always off with SHARED_FRAMES=1).
+# - idle_fps (optional): Frame rate extracted while idle (default: analysis_fps).
+# - jpeg_qscale (optional): ffmpeg JPEG quality for extracted frames, 2 (best, largest) to 31 (default 5).
+# - frame_width (optional): Downscale extracted frames to this width in pixels, keeping the aspect ratio (default: source size).
 # - stream_fps: Deprecated - all streams now fixed at 30 FPS for optimal viewing.
 
 # STREAMS = [
@@ -0,0 +1,142 @@
+import glob
+import multiprocessing
+import os
+import time
+import unittest
+
+from shared_frames import SharedRing, _LOCK_DIR
+
+SLOTS = 4
+SLOT_SIZE = 4096
+
+def _ring_name(label):
+    return f"test_ring_{label}_{os.getpid()}"
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() >= deadline:
+            raise AssertionError("timed out waiting for condition")
+        time.sleep(0.01)
+
+def _write_patterns(name, ready, stop):
+    ring = SharedRing.create_or_attach(name, SLOTS, SLOT_SIZE)
+    ready.set()
+    value = 0
+    while not stop.is_set():
+        value = (value + 1) % 256
+        ring.write(bytes([value]) * (1 + value * 13 % SLOT_SIZE))
+    ring.close()
+
+def _claim(name, results, release):
+    ring = SharedRing.create_or_attach(name, SLOTS, SLOT_SIZE)
+    results.put(ring.is_writer)
+    release.wait()
+    ring.close()
+
+def _write_then_die(name, ready, die):
+    ring = SharedRing.create_or_attach(name, SLOTS, SLOT_SIZE)
+    ring.write(b"first writer")
+    ready.set()
+    die.wait()
+    os._exit(0)  # Exit without closing, like a crashed worker
+
+def _mirror_until_takeover(name, ready, die, results):
+    # Mirrors like a worker that loses the takeover race: it must follow the new writer's ring
+    ring = SharedRing.create_or_attach(name, SLOTS, SLOT_SIZE)
+    ready.set()
+    die.wait()
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        if ring.is_stale():
+            replacement = SharedRing.attach(name, SLOTS, SLOT_SIZE)
+            if replacement is not None and not replacement.is_stale():
+                ring.close()
+                ring = replacement
+        payloads = ring.read_since(0)[1]
+        if b"second writer" in payloads:
+            results.put(("followed", ring.writer_pid))
+            ring.close()
+            return
+        time.sleep(0.02)
+    results.put(("stuck", ring.writer_pid))
+
+class SharedRingTest(unittest.TestCase):
+    def setUp(self):
+        self.context = multiprocessing.get_context("spawn")
+        self.addCleanup(self._remove_lock_files)
+
+    @staticmethod
+    def _remove_lock_files():
+        for path in glob.glob(os.path.join(_LOCK_DIR, f"test_ring_*_{os.getpid()}.lock")):
+            os.remove(path)
+
+    def test_reader_never_sees_torn_payloads(self):
+        name = _ring_name("seqlock")
+        ready, stop = self.context.Event(), self.context.Event()
+        writer = self.context.Process(target=_write_patterns, args=(name, ready, stop))
+        writer.start()
+        try:
+            self.assertTrue(ready.wait(10))
+            reader = SharedRing.create_or_attach(name, SLOTS, SLOT_SIZE)
+            self.assertFalse(reader.is_writer)
+            checked = 0
+            deadline = time.monotonic() + 1.0
+            while time.monotonic() < deadline:
+                payload = reader.read(reader.latest_seq)
+                if payload:
+                    # Every payload is one repeated byte; a torn copy would mix two writes
+                    self.assertEqual(payload, payload[:1] * len(payload))
+                    checked += 1
+            self.assertGreater(checked, 0)
+            reader.close()
+        finally:
+            stop.set()
+            writer.join(10)
+
+    def test_concurrent_startup_elects_one_writer(self):
+        name = _ring_name("election")
+        results, release = self.context.Queue(), self.context.Event()
+        workers = [self.context.Process(target=_claim, args=(name, results, release)) for _ in range(6)]
+        for worker in workers:
+            worker.start()
+        try:
+            writers = [results.get(timeout=20) for _ in workers]
+        finally:
+            release.set()
+            for worker in workers:
+                worker.join(10)
+        self.assertEqual(writers.count(True), 1)
+
+    def test_survivors_follow_the_worker_that_takes_over(self):
+        name = _ring_name("takeover")
+        ready, die = self.context.Event(), self.context.Event()
+        mirror_ready, results = self.context.Event(), self.context.Queue()
+        first = self.context.Process(target=_write_then_die, args=(name, ready, die))
+        first.start()
+        self.assertTrue(ready.wait(10))
+        mirror = self.context.Process(target=_mirror_until_takeover, args=(name, mirror_ready, die, results))
+        mirror.start()
+        self.assertTrue(mirror_ready.wait(10))
+
+        reader = SharedRing.create_or_attach(name, SLOTS, SLOT_SIZE)
+        self.assertFalse(reader.is_writer)
+        self.assertIsNone(SharedRing.create_if_unowned(name, SLOTS, SLOT_SIZE))  # The writer is alive
+        die.set()
+        first.join(10)
+
+        _wait_for(reader.is_stale)
+        successor = SharedRing.create_if_unowned(name, SLOTS, SLOT_SIZE)
+        self.assertIsNotNone(successor)
+        reader.close()
+        try:
+            successor.write(b"second writer")
+            outcome, writer_pid = results.get(timeout=20)
+            self.assertEqual(outcome, "followed")
+            self.assertEqual(writer_pid, os.getpid())
+        finally:
+            mirror.join(10)
+            successor.close()
+
+if __name__ == "__main__":
+    unittest.main()